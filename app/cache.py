@@ -0,0 +1,85 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from flask import request, make_response
+from app import app
+from app.lru import LRU
+from app.stream import versions
+
+# Dashboards ask for the same selector lists every second, from every open
+# page. Those responses are kept here, keyed by endpoint and query string,
+# together with the activity's version from app.stream at the time they were
+# made. A cached response is used while the version hasn't moved, that is
+# until this process stores points for the activity, and for at most
+# RESPONSE_CACHE_TTL seconds, for points stored by other processes.
+# Responses carry an ETag of their body, so pages that already have it get a
+# 304.
+
+CachedResponse = namedtuple('CachedResponse', ['version', 'created', 'body', 'mimetype', 'etag'])
+
+
+class ResponseCache(object):
+    # a bounded LRU of CachedResponse, with hit and miss counts
+
+    def __init__(self):
+        self._entries = LRU('RESPONSE_CACHE_SIZE')
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        fresh = entry is not None and entry.version == version and \
+            time.monotonic() - entry.created < app.config['RESPONSE_CACHE_TTL']
+        with self._lock:
+            if fresh:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        self._entries.put(key, entry)
+
+    def clear(self):
+        self._entries.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries' : len(self._entries),
+                    'capacity' : self._entries.capacity,
+                    'hits' : self.hits, 'misses' : self.misses}
+
+
+response_cache = ResponseCache()
+
+
+def cached_by_activity(view):
+    # caches the view's responses per act_id and query string
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        act_id = request.args.get('act_id', type=int)
+        if act_id is None:
+            return view(*args, **kwargs)
+        key = (request.endpoint, tuple(sorted(request.args.items(multi=True))))
+        # read before the view runs, so points stored meanwhile make the
+        # entry stale rather than getting lost
+        version = versions.get(act_id)
+        entry = response_cache.get(key, version)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            entry = CachedResponse(version, time.monotonic(), body, response.mimetype,
+                                   hashlib.sha1(body).hexdigest())
+            response_cache.put(key, entry)
+        response = app.response_class(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        return response.make_conditional(request)
+    return wrapped
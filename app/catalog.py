@@ -0,0 +1,144 @@
+import json
+import threading
+from time import time
+from sqlalchemy import and_, event, select
+from sqlalchemy.orm import Session, object_session
+from app import app, db
+from app.models import CatalogEntry, DataPoint
+
+# The distinct data keys, students, measurements and assignments of each
+# activity, for the dashboard selectors. They are stored as CatalogEntry rows
+# when points are inserted, and read from a copy in memory that is loaded
+# per activity on first use. Values committed by this process are added to
+# that copy right away; other processes' show up within CATALOG_CACHE_TTL
+# seconds.
+
+KINDS = ('key', 'student', 'measurement', 'assignment')
+# the field of DataPoint.data each kind comes from, keys aside
+_FIELDS = (('student', 'users'), ('measurement', 'measurement'), ('assignment', 'assignment'))
+
+
+def _encode(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def entries(data):
+    # the (kind, JSON text) pairs one point's data puts in the catalog
+    for key in data:
+        yield 'key', _encode(key)
+    for kind, field in _FIELDS:
+        if field in data:
+            yield kind, _encode(data[field])
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def invalidate_cache():
+    with _catalogs_lock:
+        _catalogs.clear()
+
+
+def _catalog(activity_id):
+    # {kind : set of JSON text} for the activity
+    with _catalogs_lock:
+        cached = _catalogs.get(activity_id)
+        if cached is not None and time() - cached[0] < app.config['CATALOG_CACHE_TTL']:
+            return cached[1]
+    catalog = {kind : set() for kind in KINDS}
+    for kind, value in db.session.query(CatalogEntry.kind, CatalogEntry.value) \
+            .filter(CatalogEntry.activity_id == activity_id):
+        catalog[kind].add(value)
+    with _catalogs_lock:
+        _catalogs[activity_id] = (time(), catalog)
+    return catalog
+
+
+def _order(value):
+    # numbers, then strings, then anything else, so mixed types still sort
+    if isinstance(value, (int, float)):
+        return 0, value, ''
+    if isinstance(value, str):
+        return 1, 0, value
+    return 2, 0, _encode(value)
+
+
+def values(activity_id, kind):
+    # the sorted distinct values of one kind; 2 and 2.0 count as one, like
+    # they did in the set the endpoints used to build
+    catalog = _catalog(int(activity_id))
+    with _catalogs_lock:
+        texts = list(catalog[kind])
+    distinct = {}
+    for text in texts:
+        value = json.loads(text)
+        try:
+            distinct.setdefault(value, value)
+        except TypeError:
+            distinct.setdefault(text, value)
+    return sorted(distinct.values(), key=_order)
+
+
+def _known(wanted):
+    with _catalogs_lock:
+        return {(activity_id, kind, value) for activity_id, kind, value in wanted
+                if activity_id in _catalogs and value in _catalogs[activity_id][1][kind]}
+
+
+def record(connection, info, points):
+    # Inserts the catalog entries for points, (activity_id, data) pairs,
+    # that aren't there yet, in the caller's transaction. They go into the
+    # in memory catalogs when the session (whose info this is) commits.
+    wanted = set()
+    for activity_id, data in points:
+        for kind, value in entries(data):
+            # longer values don't fit the column, and make poor menu items
+            if len(value) <= 255:
+                wanted.add((activity_id, kind, value))
+    # already inserted earlier in this transaction
+    wanted -= info.get('catalog_added', set())
+    wanted -= _known(wanted)
+    if not wanted:
+        return
+    table = CatalogEntry.__table__
+    existing = {tuple(row) for row in connection.execute(
+        select([table.c.activity_id, table.c.kind, table.c.value])
+        .where(and_(table.c.activity_id.in_({w[0] for w in wanted}),
+                    table.c.value.in_({w[2] for w in wanted}))))}
+    new = wanted - existing
+    if new:
+        connection.execute(table.insert(), [
+            {'activity_id' : activity_id, 'kind' : kind, 'value' : value}
+            for activity_id, kind, value in new])
+    info.setdefault('catalog_added', set()).update(wanted)
+
+
+def update_catalog(rows):
+    # for ingest's bulk inserts, rows as in ingest.insert_rows
+    record(db.session.connection(), db.session.info,
+           [(row['activity_id'], row['data']) for row in rows])
+
+
+@event.listens_for(DataPoint, 'after_insert')
+def _record_point(mapper, connection, target):
+    # bulk inserts skip this, so ingest.insert_rows calls update_catalog
+    session = object_session(target)
+    record(connection, session.info if session is not None else {},
+           [(target.activity_id, target.data or {})])
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_catalog_entries(session):
+    added = session.info.pop('catalog_added', None)
+    if not added:
+        return
+    with _catalogs_lock:
+        for activity_id, kind, value in added:
+            if activity_id in _catalogs:
+                _catalogs[activity_id][1][kind].add(value)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_catalog_entries(session, previous_transaction):
+    session.info.pop('catalog_added', None)
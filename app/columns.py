@@ -0,0 +1,71 @@
+import functools
+import struct
+from array import array
+import numpy as np
+from flask import json, request, make_response
+from app import app
+
+# A compact alternative to the JSON chart responses, asked for with
+# format=columns or an Accept header preferring MIMETYPE. Instead of a list
+# of {"x": .., "y": ..} objects it sends one array per field:
+#
+#   uint32 LE   length of the header
+#   header      JSON {"columns": [names], "count": n, ...}, space padded so
+#               the arrays start at a multiple of 8 bytes
+#   n float64 LE per column, in the order of "columns"
+#
+# Anything in the JSON response besides the points (cursor, max_v) goes in
+# the header. Values that aren't numbers are sent as NaN. The chart
+# templates read it with app/static/columns.js.
+
+MIMETYPE = 'application/vnd.chart-columns'
+
+
+def requested():
+    if request.args.get('format') == 'columns':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', MIMETYPE]) == MIMETYPE
+
+
+def vary_accept(view):
+    # the response depends on the Accept header, caches need to know
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        response.vary.add('Accept')
+        return response
+    return wrapped
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def from_rows(rows, keys):
+    # ([(key, values)], last id) from (id, data) rows
+    values = [array('d') for _ in keys]
+    last = None
+    for last, d in rows:
+        for column, key in zip(values, keys):
+            column.append(_number(d.get(key)))
+    return list(zip(keys, values)), last
+
+
+def pack(columns, **meta):
+    # columns are (name, values) with values a sequence of numbers or a
+    # numpy array, all the same length
+    count = len(columns[0][1]) if columns else 0
+    header = dict(meta, columns=[name for name, _ in columns], count=count)
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(4 + len(header)) % 8)
+    body = [struct.pack('<I', len(header)), header]
+    for _, values in columns:
+        body.append(np.asarray(values, dtype='<f8').tobytes())
+    return b''.join(body)
+
+
+def response(columns, **meta):
+    return app.response_class(pack(columns, **meta), mimetype=MIMETYPE)
@@ -0,0 +1,17 @@
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+# SQLite settings that only last as long as a connection, from
+# SQLITE_PRAGMAS (see DATABASE_PROFILE in config.py).
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
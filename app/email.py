@@ -1,19 +1,204 @@
-from threading import Thread
+import atexit
+import queue
+import smtplib
+import threading
+import time
 from flask import render_template
 from flask_mail import Message
 from app import app, mail
+from app.writebehind import LazyQueue
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class MailQueue(object):
+    # A bounded queue of messages sent by a fixed pool of worker threads.
+    # Each worker takes up to `batch_size` messages at a time and sends them
+    # over one SMTP connection, which it keeps open for `idle_timeout`
+    # seconds of quiet. Messages that fail for reasons that may pass (4xx
+    # replies, dropped connections) are retried `retries` times on a fresh
+    # connection, waiting `retry_delay` seconds, then twice as long, and so
+    # on. `put` waits for room for at most `put_timeout` seconds (by default
+    # not at all), then raises queue.Full.
+
+    def __init__(self, workers=2, maxsize=1000, batch_size=50, retries=3,
+                 retry_delay=1.0, idle_timeout=30.0, put_timeout=0, name='mail'):
+        self._queue = queue.Queue(maxsize)
+        self.workers = workers
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.put_timeout = put_timeout
+        self.name = name
+        self._threads = []
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.connections = 0
+        self.rejected = 0
+        atexit.register(self.close)
+
+    def put(self, msg):
+        self._start()
+        try:
+            self._queue.put(msg, block=self.put_timeout > 0, timeout=self.put_timeout or None)
+        except queue.Full:
+            self._count('rejected')
+            raise
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def join(self):
+        # wait until everything queued so far has been sent or given up on
+        self._queue.join()
+
+    def close(self):
+        # sends what is queued, then stops the workers
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queue_depth' : self.depth(),
+                'queue_capacity' : self.maxsize,
+                'workers' : len(self._threads),
+                'sent' : self.sent,
+                'failed' : self.failed,
+                'retried' : self.retried,
+                'connections' : self.connections,
+                'rejected' : self.rejected,
+            }
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def _start(self):
+        if self._threads or self._stopping.is_set():
+            return
+        with self._start_lock:
+            if not self._threads:
+                for n in range(self.workers):
+                    thread = threading.Thread(target=self._run, daemon=True,
+                                              name='{}-{}'.format(self.name, n))
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _take(self, timeout):
+        # up to batch_size messages, waiting at most timeout for the first;
+        # short waits, so close() is noticed
+        deadline = time.monotonic() + timeout
+        batch = []
+        while not batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (self._stopping.is_set() and self._queue.empty()):
+                return batch
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+            except queue.Empty:
+                pass
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with app.app_context():
+            connection = None
+            while True:
+                batch = self._take(self.idle_timeout if connection is not None else float('inf'))
+                if not batch:
+                    # idle, or stopping with nothing left
+                    connection = self._disconnect(connection)
+                    if self._stopping.is_set():
+                        return
+                    continue
+                for msg in batch:
+                    connection = self._send(connection, msg)
+                    self._queue.task_done()
+
+    def _connect(self):
+        connection = mail.connect().__enter__()
+        self._count('connections')
+        return connection
+
+    def _disconnect(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
+
+    def _send(self, connection, msg):
+        # sends msg, retrying on a new connection; returns the connection
+        # to use for the next message
+        for attempt in range(self.retries + 1):
+            try:
+                if connection is None:
+                    connection = self._connect()
+                connection.send(msg)
+                self._count('sent')
+                return connection
+            except Exception as e:
+                transient = _transient(e)
+                # smtplib resets the connection after refusals, so only the
+                # ones that may be the connection's fault need a new one
+                if transient:
+                    connection = self._disconnect(connection)
+                if not transient or attempt == self.retries:
+                    self._count('failed')
+                    app.logger.exception('%s: could not send %r to %s', self.name,
+                                         msg.subject, ', '.join(msg.send_to))
+                    return connection
+                self._count('retried')
+                self._stopping.wait(self.retry_delay * 2 ** attempt)
+        return connection
+
+
+def _transient(e):
+    # worth trying again: 4xx replies and connection trouble
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPException):
+        return isinstance(e, smtplib.SMTPServerDisconnected)
+    return isinstance(e, OSError)
+
+
+mail_queue = LazyQueue(lambda: MailQueue(
+    workers=app.config['MAIL_WORKERS'],
+    maxsize=app.config['MAIL_QUEUE_SIZE'],
+    batch_size=app.config['MAIL_BATCH_SIZE'],
+    retries=app.config['MAIL_RETRIES'],
+    retry_delay=app.config['MAIL_RETRY_DELAY'],
+    idle_timeout=app.config['MAIL_IDLE_TIMEOUT'],
+    put_timeout=app.config['MAIL_QUEUE_TIMEOUT']))
+# None if no mail was sent yet
+mail_queue_stats = mail_queue.stats
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    # False when the queue is full; the message is logged and dropped, the
+    # request that sent it goes on
+    try:
+        mail_queue().put(msg)
+    except queue.Full:
+        app.logger.error('mail queue full, dropped %r to %s', subject, ', '.join(recipients))
+        return False
+    return True
 
 
 def send_password_reset_email(user):
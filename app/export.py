@@ -0,0 +1,191 @@
+import csv
+import gzip
+import io
+import json
+import click
+from app import app, queries
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Exports every data point of an activity as a table, one column per key
+# found in the points' data (what get_data_keys lists), for analysis outside
+# the app. Parquet and Arrow files need pyarrow; without it we write gzipped
+# CSV. Points are read EXPORT_CHUNK_SIZE at a time, once to find the columns
+# and their types and once to write them, so memory use doesn't grow with
+# the size of the activity. The second pass stops at the last point the
+# first one saw, so points stored meanwhile can't bring keys or types the
+# columns weren't made for.
+
+FORMATS = ('parquet', 'arrow', 'csv')
+EXTENSIONS = {'parquet' : '.parquet', 'arrow' : '.arrow', 'csv' : '.csv.gz'}
+
+# every row also gets these, before the data columns
+META_COLUMNS = ('data_point_id', 'stored_at')
+
+
+def default_format():
+    return 'parquet' if pyarrow is not None else 'csv'
+
+
+def _pages(act_id, until=None):
+    # lists of (id, timestamp, data), in id order, up to the id until
+    chunk = app.config['EXPORT_CHUNK_SIZE']
+    last = 0
+    while True:
+        page = queries.export_points(act_id, last, until).limit(chunk).all()
+        if not page:
+            return
+        yield page
+        last = page[-1][0]
+
+
+def _kind(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'str'
+
+
+def _widen(kind, new):
+    # the column type that holds values of both kinds
+    if kind is None or kind == new:
+        return new
+    if new is None:
+        return kind
+    if {kind, new} == {'int', 'float'}:
+        return 'float'
+    return 'str'
+
+
+def columns(act_id):
+    # ([(key, kind)], until): the data keys of the activity, sorted by key,
+    # and the id of the last point looked at; kind is 'bool', 'int',
+    # 'float' or 'str' ('str' for lists and mixed types)
+    kinds = {}
+    until = 0
+    for page in _pages(act_id):
+        for _, _, data in page:
+            for key, value in data.items():
+                kinds[key] = _widen(kinds.get(key), _kind(value))
+        until = page[-1][0]
+    return [(key, kinds[key] or 'str') for key in sorted(kinds)], until
+
+
+def _cell(value, kind):
+    if value is None:
+        return None
+    if kind == 'str':
+        if isinstance(value, str):
+            return value
+        return json.dumps(value)
+    if kind == 'float':
+        return float(value)
+    return value
+
+
+def _rows(act_id, cols, until):
+    # pages of rows, each a list of values in META_COLUMNS + cols order
+    for page in _pages(act_id, until):
+        yield [[id, timestamp] + [_cell(data.get(key), kind) for key, kind in cols]
+               for id, timestamp, data in page]
+
+
+def _arrow_schema(cols):
+    types = {'bool' : pyarrow.bool_(), 'int' : pyarrow.int64(),
+             'float' : pyarrow.float64(), 'str' : pyarrow.string()}
+    return pyarrow.schema(
+        [('data_point_id', pyarrow.int64()), ('stored_at', pyarrow.timestamp('us'))] +
+        [(key, types[kind]) for key, kind in cols])
+
+
+def _write_arrow(act_id, cols, until, out, format):
+    schema = _arrow_schema(cols)
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(out, schema)
+    else:
+        writer = pyarrow.ipc.new_file(out, schema)
+    try:
+        for rows in _rows(act_id, cols, until):
+            arrays = [pyarrow.array([row[i] for row in rows], type=field.type)
+                      for i, field in enumerate(schema)]
+            batch = pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+            if format == 'parquet':
+                writer.write_table(pyarrow.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+    finally:
+        writer.close()
+
+
+def _csv_chunks(act_id, cols, until):
+    # the gzipped CSV, a page of points at a time
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as zipped:
+        text = io.TextIOWrapper(zipped, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(list(META_COLUMNS) + [key for key, _ in cols])
+        for rows in _rows(act_id, cols, until):
+            writer.writerows([[id, timestamp.isoformat() if timestamp else None] + values
+                              for id, timestamp, *values in rows])
+            text.flush()
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        text.flush()
+        text.detach()
+    yield buffer.getvalue()
+
+
+def csv_chunks(act_id):
+    # the gzipped CSV export as a stream of bytes, for responses
+    cols, until = columns(act_id)
+    return _csv_chunks(act_id, cols, until)
+
+
+def check_format(format):
+    if format not in FORMATS:
+        raise ValueError('unknown export format {!r}'.format(format))
+    if format != 'csv' and pyarrow is None:
+        raise ValueError('{} export needs pyarrow'.format(format))
+
+
+def export_activity(act_id, out, format=None):
+    # writes the activity's points to the binary file object out, returns
+    # the number of columns
+    format = format or default_format()
+    check_format(format)
+    cols, until = columns(act_id)
+    if format == 'csv':
+        for chunk in _csv_chunks(act_id, cols, until):
+            out.write(chunk)
+    else:
+        _write_arrow(act_id, cols, until, out, format)
+    return len(META_COLUMNS) + len(cols)
+
+
+@app.cli.command('export')
+@click.argument('act_id', type=int)
+@click.argument('path', required=False)
+@click.option('--format', type=click.Choice(FORMATS), default=None,
+              help='parquet or arrow (with pyarrow installed) or csv')
+def export_command(act_id, path, format):
+    """Export the data points of an activity."""
+    format = format or default_format()
+    try:
+        check_format(format)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    path = path or 'activity_{}{}'.format(act_id, EXTENSIONS[format])
+    with open(path, 'wb') as out:
+        ncols = export_activity(act_id, out, format)
+    click.echo('Wrote {} columns to {}'.format(ncols, path))
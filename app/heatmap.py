@@ -0,0 +1,144 @@
+import threading
+import numpy as np
+from app import app, queries
+from app.lru import LRU
+
+# Heatmaps are drawn from a grid of HEATMAP_CELL_SIZE cells instead of one
+# square per submitted point. The grid for an activity/measurement/student
+# is cached and brought up to date with just the points stored since it was
+# last read, so the response size depends on the number of cells, not on
+# the number of submissions.
+
+STATS = ('mean', 'max', 'count', 'sum')
+
+
+class HeatmapGrid(object):
+    # count, sum and max of v per cell, plus the id of the newest point that
+    # landed in each cell, so we can tell a client which cells changed
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cursor = 0
+        self.lock = threading.Lock()
+        self._rows = {}
+        self.ix = np.zeros(0, dtype=np.int64)
+        self.iy = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.total = np.zeros(0)
+        self.maximum = np.zeros(0)
+        self.updated = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, ids, x, y, v):
+        # ids, x, y and v are equally long arrays of new points
+        if len(ids) == 0:
+            return
+        cells = np.stack([np.floor_divide(x, self.cell_size).astype(np.int64),
+                          np.floor_divide(y, self.cell_size).astype(np.int64)], axis=1)
+        cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        n = len(cells)
+        counts = np.bincount(inverse, minlength=n)
+        sums = np.bincount(inverse, weights=v, minlength=n)
+        maxes = np.full(n, -np.inf)
+        np.maximum.at(maxes, inverse, v)
+        newest = np.zeros(n, dtype=np.int64)
+        np.maximum.at(newest, inverse, ids)
+
+        # where each cell of this batch lives in our arrays; this loop is
+        # over distinct cells, which the grid resolution bounds
+        rows = np.empty(n, dtype=np.int64)
+        added = []
+        for i, cell in enumerate(map(tuple, cells.tolist())):
+            row = self._rows.get(cell)
+            if row is None:
+                row = self._rows[cell] = len(self._rows)
+                added.append(cell)
+            rows[i] = row
+        if added:
+            added = np.array(added, dtype=np.int64)
+            k = len(added)
+            self.ix = np.concatenate([self.ix, added[:, 0]])
+            self.iy = np.concatenate([self.iy, added[:, 1]])
+            self.count = np.concatenate([self.count, np.zeros(k, dtype=np.int64)])
+            self.total = np.concatenate([self.total, np.zeros(k)])
+            self.maximum = np.concatenate([self.maximum, np.full(k, -np.inf)])
+            self.updated = np.concatenate([self.updated, np.zeros(k, dtype=np.int64)])
+        # rows are distinct within a batch, so plain fancy indexing is safe
+        self.count[rows] += counts
+        self.total[rows] += sums
+        self.maximum[rows] = np.maximum(self.maximum[rows], maxes)
+        self.updated[rows] = np.maximum(self.updated[rows], newest)
+        self.cursor = max(self.cursor, int(ids.max()))
+
+    def values(self, stat):
+        if stat == 'count':
+            return self.count.astype(float)
+        if stat == 'sum':
+            return self.total
+        if stat == 'max':
+            return self.maximum
+        return self.total / np.maximum(self.count, 1)
+
+    def columns(self, stat='mean', since=None):
+        # x, y and v arrays of the cells touched by points after since (all
+        # cells if since is None), and max_v over the whole grid
+        values = self.values(stat)
+        max_v = float(values.max()) if len(values) else 0
+        mask = slice(None) if since is None else self.updated > since
+        return self.ix[mask] * self.cell_size, self.iy[mask] * self.cell_size, \
+            values[mask], max_v
+
+    def cells(self, stat='mean', since=None):
+        # ([{'x', 'y', 'v'}, ...], max_v), as above
+        x, y, v, max_v = self.columns(stat, since)
+        return [{'x' : x, 'y' : y, 'v' : v}
+                for x, y, v in zip(x.tolist(), y.tolist(), v.tolist())], max_v
+
+
+# least recently used grids fall out beyond HEATMAP_CACHE_SIZE
+_grids = LRU('HEATMAP_CACHE_SIZE')
+
+
+def _grid(key):
+    return _grids.setdefault(key, lambda: HeatmapGrid(app.config['HEATMAP_CELL_SIZE']))
+
+
+def invalidate_cache():
+    _grids.clear()
+
+
+def _numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def heatmap(act_id, measurement, student):
+    # the up to date grid for one activity/measurement/student ("all" for
+    # everyone); only reads the points stored since the last call
+    grid = _grid((int(act_id), measurement, student))
+    with grid.lock:
+        ids, xs, ys, vs = [], [], [], []
+        last = grid.cursor
+        for last, d in queries.measurement_points(act_id, measurement, student, grid.cursor):
+            x, y, v = d.get('x'), d.get('y'), d.get('v')
+            if _numeric(x) and _numeric(y) and _numeric(v):
+                ids.append(last)
+                xs.append(x)
+                ys.append(y)
+                vs.append(v)
+        grid.add(np.array(ids, dtype=np.int64), np.array(xs, dtype=float),
+                 np.array(ys, dtype=float), np.array(vs, dtype=float))
+        # points we skipped still count as read
+        grid.cursor = max(grid.cursor, last)
+    return grid
+
+
+def heatmap_update(act_id, measurement, student, since, stat='mean'):
+    # the cells that changed after since, in the shape of the since responses
+    grid = heatmap(act_id, measurement, student)
+    with grid.lock:
+        data, max_v = grid.cells(stat, since)
+        cursor = max(grid.cursor, since)
+    return {'data' : data, 'max_v' : max_v, 'cursor' : cursor}
@@ -0,0 +1,165 @@
+from datetime import datetime
+from flask.signals import Namespace
+from sqlalchemy import and_, bindparam, case, event, select
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from app.models import DataPoint, ScoreAggregate
+from app.writebehind import LazyQueue, WriteBehindQueue
+from app.catalog import update_catalog
+from app import logolist
+
+
+_signals = Namespace()
+
+# sent with activity_ids (a set) after new data points have been committed
+data_points_added = _signals.signal('data-points-added')
+
+
+def parse_rows(keys, rows):
+    # keys is a NetLogo list of keys, rows a NetLogo list of value lists.
+    # Returns (datas, errors) where errors is a list of [index, message] for
+    # the rows that could not be used, so one bad row doesn't sink the batch.
+    ks = logolist.loads(keys)
+    rs = logolist.loads(rows)
+    if not isinstance(ks, (list, tuple)) or not isinstance(rs, (list, tuple)):
+        raise ValueError("keys and rows must be lists")
+    datas = []
+    errors = []
+    for n, row in enumerate(rs):
+        if not isinstance(row, (list, tuple)):
+            errors.append([n, "Row is not a list"])
+        elif len(row) != len(ks):
+            errors.append([n, "Length of keys and values did not match"])
+        else:
+            datas.append({ks[i] : row[i] for i in range(len(ks))})
+    return datas, errors
+
+
+def data_point_row(activity_id, data):
+    row = {'data' : data, 'activity_id' : activity_id, 'timestamp' : datetime.utcnow()}
+    row.update(DataPoint.indexed_fields(data))
+    return row
+
+
+def insert_rows(rows):
+    # one executemany and one commit for the whole batch
+    if not rows:
+        return 0
+    db.session.bulk_insert_mappings(DataPoint, rows)
+    update_score_aggregates(rows)
+    update_catalog(rows)
+    db.session.commit()
+    data_points_added.send(app, activity_ids={row['activity_id'] for row in rows})
+    return len(rows)
+
+
+def update_score_aggregates(rows, connection=None):
+    # Fold the high score averages carried by rows into ScoreAggregate, in
+    # the caller's transaction (the session's, or connection's). Increments
+    # happen in SQL, so concurrent writers don't overwrite each other's
+    # totals.
+    deltas = {}
+    for row in rows:
+        scores = ScoreAggregate.scores(row['data'])
+        if scores is None:
+            continue
+        name, values = scores
+        for metric, value in values.items():
+            key = (row['activity_id'], name, metric)
+            delta = deltas.get(key)
+            if delta is None:
+                deltas[key] = [1, value, value, value]
+            else:
+                delta[0] += 1
+                delta[1] += value
+                delta[2] = min(delta[2], value)
+                delta[3] = max(delta[3], value)
+    if not deltas:
+        return
+    if connection is None:
+        connection = db.session.connection()
+    table = ScoreAggregate.__table__
+    existing = {tuple(row) for row in connection.execute(
+        select([table.c.activity_id, table.c.name, table.c.metric])
+        .where(and_(table.c.activity_id.in_({k[0] for k in deltas}),
+                    table.c.name.in_({k[1] for k in deltas}))))}
+    inserts = []
+    updates = []
+    for (activity_id, name, metric), (count, total, minimum, maximum) in deltas.items():
+        if (activity_id, name, metric) in existing:
+            updates.append({'b_activity_id' : activity_id, 'b_name' : name, 'b_metric' : metric,
+                            'b_count' : count, 'b_total' : total,
+                            'b_minimum' : minimum, 'b_maximum' : maximum})
+        else:
+            inserts.append({'activity_id' : activity_id, 'name' : name, 'metric' : metric,
+                            'count' : count, 'total' : total,
+                            'minimum' : minimum, 'maximum' : maximum})
+    if inserts:
+        updates += _insert_aggregates(connection, table, inserts)
+    if updates:
+        connection.execute(
+            table.update()
+            .where(and_(table.c.activity_id == bindparam('b_activity_id'),
+                        table.c.name == bindparam('b_name'),
+                        table.c.metric == bindparam('b_metric')))
+            .values(count=table.c.count + bindparam('b_count'),
+                    total=table.c.total + bindparam('b_total'),
+                    minimum=case([(table.c.minimum <= bindparam('b_minimum'), table.c.minimum)],
+                                 else_=bindparam('b_minimum')),
+                    maximum=case([(table.c.maximum >= bindparam('b_maximum'), table.c.maximum)],
+                                 else_=bindparam('b_maximum'))),
+            updates)
+
+
+def _insert_aggregates(connection, table, inserts):
+    # Inserts new aggregate rows, in savepoints: another writer may have
+    # inserted some of them since we looked. Returns those as updates.
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert(), inserts)
+        savepoint.commit()
+        return []
+    except IntegrityError:
+        savepoint.rollback()
+    updates = []
+    for insert in inserts:
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(table.insert(), insert)
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+            updates.append({'b_' + key : value for key, value in insert.items()})
+    return updates
+
+
+@event.listens_for(DataPoint, 'after_insert')
+def _update_score_aggregates(mapper, connection, target):
+    # bulk inserts skip this, so insert_rows calls update_score_aggregates
+    update_score_aggregates([{'activity_id' : target.activity_id, 'data' : target.data or {}}],
+                            connection)
+
+
+def insert_data_points(activity_id, datas):
+    return insert_rows([data_point_row(activity_id, data) for data in datas])
+
+
+def _flush_rows(rows):
+    with app.app_context():
+        insert_rows(rows)
+
+
+write_behind_queue = LazyQueue(lambda: WriteBehindQueue(
+    _flush_rows,
+    maxsize=app.config['INGEST_QUEUE_SIZE'],
+    batch_size=app.config['INGEST_FLUSH_ROWS'],
+    interval=app.config['INGEST_FLUSH_INTERVAL'],
+    name='datapoint-writer',
+    retries=app.config['INGEST_FLUSH_RETRIES']))
+# None if the queue was never needed
+write_behind_stats = write_behind_queue.stats
+
+
+def enqueue_data_point(activity_id, data):
+    # raises queue.Full when the writer is behind
+    write_behind_queue().put(data_point_row(activity_id, data))
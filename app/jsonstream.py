@@ -0,0 +1,58 @@
+from flask import json, stream_with_context
+from app import app
+
+# The big dashboard responses are written out while the rows are still being
+# read, instead of building the whole list and calling jsonify on it. Rows
+# come from the database JSON_STREAM_CHUNK at a time (Query.yield_per) and go
+# out in pieces of as many items, so memory doesn't grow with the activity
+# and the browser gets the first points right away.
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def json_array(items):
+    # the text of a JSON array of items, in pieces
+    size = app.config['JSON_STREAM_CHUNK']
+    yield '['
+    separator = ''
+    batch = []
+    for item in items:
+        batch.append(_dumps(item))
+        if len(batch) >= size:
+            yield separator + ','.join(batch)
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']'
+
+
+def streamed(pieces):
+    return app.response_class(stream_with_context(pieces), mimetype='application/json')
+
+
+def points_response(rows, xkey='x', ykey='y', since=None):
+    # rows are (id, data); sends [{x, y}, ...] from the data's xkey and ykey,
+    # or with since {"data": [...], "cursor": <last id>} like the polling
+    # endpoints expect. Points without both keys are left out: once the
+    # response has started an error can only cut it short.
+    def generate():
+        cursor = since
+
+        def points():
+            nonlocal cursor
+            for cursor, d in rows:
+                if xkey in d and ykey in d:
+                    yield {'x' : d[xkey], 'y' : d[ykey]}
+
+        if since is None:
+            yield from json_array(points())
+            return
+        yield '{"data":'
+        yield from json_array(points())
+        # the cursor is only known once all the points are out
+        yield ',"cursor":{}}}'.format(_dumps(cursor))
+
+    return streamed(generate())
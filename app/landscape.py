@@ -0,0 +1,150 @@
+import ast
+import numpy as np
+from app import app
+from app.lru import LRU
+
+# The function students optimize in a replay ('function' in the data of a
+# point, like "x^2 - 3*x" or "sin(x) * cos(y)"), evaluated over a grid so the
+# replay can show the landscape under the attempts. Functions of x are
+# curves, functions of x and y surfaces. The text is compiled by walking
+# its syntax tree with a fixed set of operators, functions and names, never
+# with eval, and each activity/assignment's landscape is evaluated once and
+# cached until its function changes.
+
+MAX_LENGTH = 1000
+
+_BINARY = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: np.true_divide, ast.Mod: np.mod, ast.Pow: np.power}
+_UNARY = {ast.USub: np.negative, ast.UAdd: np.positive}
+# name : (NumPy function, number of arguments); they are ufuncs, which take
+# an extra argument as where to write the result, so the count matters
+FUNCTIONS = {'sin': (np.sin, 1), 'cos': (np.cos, 1), 'tan': (np.tan, 1),
+             'asin': (np.arcsin, 1), 'acos': (np.arccos, 1), 'atan': (np.arctan, 1),
+             'sinh': (np.sinh, 1), 'cosh': (np.cosh, 1), 'tanh': (np.tanh, 1),
+             'exp': (np.exp, 1), 'log': (np.log, 1), 'log10': (np.log10, 1), 'ln': (np.log, 1),
+             'sqrt': (np.sqrt, 1), 'abs': (np.abs, 1), 'floor': (np.floor, 1),
+             'ceil': (np.ceil, 1), 'min': (np.minimum, 2), 'max': (np.maximum, 2)}
+CONSTANTS = {'pi': np.pi, 'e': np.e}
+VARIABLES = ('x', 'y')
+
+
+def _compile(node, used):
+    # a function of {variable : array} computing node
+    if isinstance(node, ast.Constant):
+        # bools are ints to Python; and numbers become floats, so 9**9**9
+        # overflows to inf instead of taking forever
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError('not a number: {!r}'.format(node.value))
+        value = float(node.value)
+        return lambda env: value
+    if isinstance(node, ast.Name):
+        if node.id in VARIABLES:
+            used.add(node.id)
+            name = node.id
+            return lambda env: env[name]
+        if node.id in CONSTANTS:
+            value = CONSTANTS[node.id]
+            return lambda env: value
+        raise ValueError('unknown name: {}'.format(node.id))
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+        op = _BINARY[type(node.op)]
+        left, right = _compile(node.left, used), _compile(node.right, used)
+        return lambda env: op(left(env), right(env))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY:
+        op = _UNARY[type(node.op)]
+        operand = _compile(node.operand, used)
+        return lambda env: op(operand(env))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+            and node.func.id in FUNCTIONS and not node.keywords:
+        func, arity = FUNCTIONS[node.func.id]
+        if len(node.args) != arity:
+            raise ValueError('{} takes {} argument{}'.format(
+                node.func.id, arity, '' if arity == 1 else 's'))
+        args = [_compile(arg, used) for arg in node.args]
+        return lambda env: func(*[arg(env) for arg in args])
+    raise ValueError('not allowed in a function: {}'.format(type(node).__name__))
+
+
+def compile_function(text):
+    # (f, surface): f takes x and y arrays, surface tells if it uses y.
+    # Raises ValueError for anything but arithmetic on numbers, x, y and
+    # the names above.
+    if not isinstance(text, str) or len(text) > MAX_LENGTH:
+        raise ValueError('not a function')
+    try:
+        # ^ is power in NetLogo, and needs Python's precedence for that
+        tree = ast.parse(text.strip().replace('^', '**'), mode='eval')
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        raise ValueError('not a function: {!r}'.format(text))
+    used = set()
+    try:
+        f = _compile(tree.body, used)
+    except RecursionError:
+        raise ValueError('function too long')
+
+    def evaluate(x, y=None):
+        try:
+            with np.errstate(all='ignore'):
+                return f({'x' : x, 'y' : y})
+        except RecursionError as e:
+            # too deeply nested
+            raise ValueError('cannot evaluate {!r}: {}'.format(text, e))
+    return evaluate, 'y' in used
+
+
+def _listed(values):
+    # for JSON, which has no NaN or infinity
+    values = np.asarray(values, dtype=float)
+    listed = values.astype(object)
+    listed[~np.isfinite(values)] = None
+    return listed.tolist()
+
+
+def evaluate(text, bounds, steps):
+    # {'function', 'x', 'y'} for a curve, plus 'z' (a row per y) for a
+    # surface, over bounds (xmin, xmax, ymin, ymax) in steps steps
+    f, surface = compile_function(text)
+    xmin, xmax, ymin, ymax = bounds
+    x = np.linspace(xmin, xmax, steps + 1)
+    if not surface:
+        y = np.broadcast_to(f(x), x.shape)
+        return {'function' : text, 'x' : _listed(x), 'y' : _listed(y)}
+    y = np.linspace(ymin, ymax, steps + 1)
+    grid_x, grid_y = np.meshgrid(x, y)
+    z = np.broadcast_to(f(grid_x, grid_y), grid_x.shape)
+    return {'function' : text, 'x' : _listed(x), 'y' : _listed(y), 'z' : _listed(z)}
+
+
+def bounds(data):
+    # the area to draw, from the point that had the function or the defaults
+    low, high = app.config['LANDSCAPE_RANGE']
+    limits = []
+    for key, default in (('xmin', low), ('xmax', high), ('ymin', low), ('ymax', high)):
+        try:
+            value = float(data.get(key, default))
+        except (TypeError, ValueError):
+            value = default
+        limits.append(value if np.isfinite(value) else default)
+    return tuple(limits)
+
+
+_landscapes = LRU('LANDSCAPE_CACHE_SIZE')
+
+
+def invalidate_cache():
+    _landscapes.clear()
+
+
+def landscape(act_id, assignment, text, limits):
+    # the evaluated landscape, or None if text isn't a function we can draw
+    key = (int(act_id), assignment)
+    cached = _landscapes.get(key)
+    if cached is not None and cached[0] == (text, limits):
+        return cached[1]
+    try:
+        result = evaluate(text, limits, app.config['LANDSCAPE_STEPS'])
+    except ValueError as e:
+        app.logger.warning('no landscape for activity %s, assignment %s: %s', act_id, assignment, e)
+        result = None
+    _landscapes.put(key, ((text, limits), result))
+    return result
@@ -0,0 +1,56 @@
+import queue
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam
+from app import app, db
+from app.models import User
+from app.writebehind import LazyQueue, WriteBehindQueue
+
+# before_request used to write current_user.last_seen and commit on every
+# request, dashboard polls included. Now a user's last_seen is only queued
+# when it is more than LAST_SEEN_INTERVAL seconds old, and the queue is
+# written in the background, one UPDATE per batch.
+
+
+def _write(items):
+    # items are (user_id, when); keep the latest per user
+    latest = {}
+    for user_id, when in items:
+        if user_id not in latest or when > latest[user_id]:
+            latest[user_id] = when
+    with app.app_context():
+        db.session.execute(
+            User.__table__.update()
+            .where(User.__table__.c.id == bindparam('user_id'))
+            .values(last_seen=bindparam('when')),
+            [{'user_id' : user_id, 'when' : when} for user_id, when in latest.items()])
+        db.session.commit()
+    # the database has them now; keep only entries queued since
+    for user_id, when in latest.items():
+        if _queued.get(user_id, when) <= when:
+            _queued.pop(user_id, None)
+
+
+# when we last queued an update for each user, so we don't queue another
+# before the first one has been written; removed once it is
+_queued = {}
+
+
+last_seen_queue = LazyQueue(lambda: WriteBehindQueue(
+    _write, maxsize=1000, batch_size=100, interval=app.config['LAST_SEEN_FLUSH_INTERVAL'],
+    name='last-seen-writer'))
+
+
+def mark_seen(user):
+    # returns True if an update was queued
+    now = datetime.utcnow()
+    interval = timedelta(seconds=app.config['LAST_SEEN_INTERVAL'])
+    last = max(user.last_seen or datetime.min, _queued.get(user.id, datetime.min))
+    if now - last < interval:
+        return False
+    try:
+        last_seen_queue().put((user.id, now))
+    except queue.Full:
+        # last_seen is only informational, try again on a later request
+        return False
+    _queued[user.id] = now
+    return True
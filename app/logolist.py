@@ -0,0 +1,163 @@
+import ast
+import math
+import re
+
+# Reading and writing the list literals NetLogo models send us and read back.
+# loads accepts NetLogo syntax ([1 2.5 "a" true [3]]) as well as the Python
+# style ([1, 2.5, 'a', True, [3]]) that used to go through ast.literal_eval.
+# dumps writes NetLogo syntax that `read-from-string` / `runresult` accept.
+
+_TOKEN = re.compile(r'''\s*(?:
+      (?P<open>[\[(])
+    | (?P<close>[\])])
+    | (?P<comma>,)
+    | (?P<float>[-+]?(?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?\d+[eE][-+]?\d+)
+    | (?P<int>[-+]?\d+)
+    | (?P<str>"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*')
+    | (?P<word>[A-Za-z_][A-Za-z_0-9]*)
+    )''', re.VERBOSE | re.DOTALL)
+
+_WORDS = {
+    'true' : True, 'True' : True,
+    'false' : False, 'False' : False,
+    'nobody' : None, 'None' : None,
+}
+
+_CLOSERS = {'[' : ']', '(' : ')'}
+
+# the common /add_data payload is a flat list of numbers, which we can split
+# and convert without going through the tokenizer one token at a time
+_FLAT_NUMBERS = re.compile(r'\s*\[([-+0-9.eE,\s]*)\]\s*\Z')
+_SEPARATORS = re.compile(r'[\s,]+')
+# same for a flat list of strings without escapes, like the keys list
+_FLAT_STRINGS = re.compile(r'''\s*\[\s*(?:(?:"[^"\\]*"|'[^'\\]*')(?:\s*,\s*|\s+)?)*\]\s*\Z''')
+_STRING_ITEM = re.compile(r'"([^"]*)"|\'([^\']*)\'')
+
+
+def _number(token):
+    if '.' in token or 'e' in token or 'E' in token:
+        return float(token)
+    return int(token)
+
+
+def _flat_numbers(inner):
+    tokens = _SEPARATORS.split(inner.strip(' \t\r\n,'))
+    if tokens == ['']:
+        return []
+    return [_number(t) for t in tokens]
+
+
+def _string(token):
+    if '\\' in token:
+        # escapes are rare, let Python decode them exactly as before
+        return ast.literal_eval(token)
+    return token[1:-1]
+
+
+def loads(s):
+    # Parse one list literal (or a single value) into Python lists, numbers,
+    # strings, booleans and None. Raises ValueError on malformed input.
+    flat = _FLAT_NUMBERS.match(s)
+    if flat is not None:
+        try:
+            return _flat_numbers(flat.group(1))
+        except ValueError:
+            pass  # something like [1-2], leave it to the tokenizer
+    elif _FLAT_STRINGS.match(s) is not None:
+        return [a or b for a, b in _STRING_ITEM.findall(s)]
+    match = _TOKEN.match
+    pos = 0
+    result = []
+    items = result
+    # each frame is (items, closer, saw_comma) for an enclosing list
+    stack = []
+    closer = None
+    saw_comma = False
+    while True:
+        m = match(s, pos)
+        if m is None:
+            if s[pos:].strip():
+                raise ValueError('Unexpected {!r} at position {}'.format(s[pos:pos + 10], pos))
+            break
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == 'int':
+            items.append(int(m.group(kind)))
+        elif kind == 'float':
+            items.append(float(m.group(kind)))
+        elif kind == 'str':
+            items.append(_string(m.group(kind)))
+        elif kind == 'open':
+            stack.append((items, closer, saw_comma))
+            items = []
+            closer = _CLOSERS[m.group(kind)]
+            saw_comma = False
+        elif kind == 'close':
+            if m.group(kind) != closer:
+                raise ValueError('Unbalanced {!r} at position {}'.format(m.group(kind), pos - 1))
+            value = items
+            if closer == ')':
+                # (x) is just x in Python, (x,) and (x, y) are tuples
+                value = tuple(items) if saw_comma or not items else items[0]
+            items, closer, saw_comma = stack.pop()
+            items.append(value)
+        elif kind == 'comma':
+            saw_comma = True
+        else:
+            word = m.group(kind)
+            if word not in _WORDS:
+                raise ValueError('Unknown word {!r} at position {}'.format(word, m.start(kind)))
+            items.append(_WORDS[word])
+    if stack:
+        raise ValueError('Unclosed {!r}'.format('[' if closer == ']' else '('))
+    if len(result) != 1:
+        raise ValueError('Expected exactly one value, found {}'.format(len(result)))
+    return result[0]
+
+
+_ESCAPES = {'\\' : '\\\\', '"' : '\\"', '\n' : '\\n', '\t' : '\\t', '\r' : '\\r'}
+_NEEDS_ESCAPE = re.compile(r'[\\"\n\t\r]')
+
+
+def _escape(match):
+    return _ESCAPES[match.group()]
+
+
+def _encode(value, out):
+    # appends the pieces of value to out, which is joined once at the end
+    if value is None:
+        out.append('nobody')
+    elif value is True:
+        out.append('true')
+    elif value is False:
+        out.append('false')
+    elif isinstance(value, str):
+        out.append('"')
+        out.append(_NEEDS_ESCAPE.sub(_escape, value))
+        out.append('"')
+    elif isinstance(value, int):
+        out.append(str(int(value)))
+    elif isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            raise ValueError('NetLogo has no number {!r}'.format(value))
+        out.append(repr(value))
+    elif isinstance(value, (list, tuple)):
+        out.append('[')
+        first = True
+        for item in value:
+            if not first:
+                out.append(' ')
+            first = False
+            _encode(item, out)
+        out.append(']')
+    elif isinstance(value, dict):
+        # [[key value] ...], which table:from-list reads
+        _encode([[k, v] for k, v in value.items()], out)
+    else:
+        raise TypeError('Cannot write {!r} as a NetLogo value'.format(value))
+
+
+def dumps(value):
+    out = []
+    _encode(value, out)
+    return ''.join(out)
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from app import app
+
+# The in-process caches (heatmap grids, replay series, landscapes, selector
+# responses) keep what was used last and drop the rest beyond a size set in
+# app.config, read on every insert so it can be changed while running.
+
+
+class LRU(object):
+    # a dict bounded to app.config[size_key] entries, safe to share between
+    # threads
+
+    def __init__(self, size_key):
+        self.size_key = size_key
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def capacity(self):
+        return app.config[self.size_key]
+
+    def get(self, key):
+        # the value, now the most recently used, or None
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._trim(key)
+
+    def setdefault(self, key, make):
+        # the value, or a new one from make() if there is none
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                value = self._entries[key] = make()
+            self._trim(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _trim(self, key):
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
@@ -0,0 +1,249 @@
+import hmac
+import threading
+import time
+from collections import defaultdict
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+# Request and database numbers per endpoint, served in the Prometheus text
+# format on /metrics (to local addresses, or with METRICS_TOKEN to those
+# sending it). Requests slower than
+# METRICS_SLOW_REQUEST_MS are logged with their query count and time.
+#
+# Queries are attributed to the request running on the same thread, rows
+# are counted as they are fetched, and for streamed responses the bytes and
+# the duration cover the whole stream.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class RequestStats(object):
+    # what one request did; filled in by the hooks below
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.status = None
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rows = 0
+
+
+_lock = threading.Lock()
+_requests = defaultdict(int)
+_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+_queries_per_request = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+_query_seconds = defaultdict(float)
+_rows = defaultdict(int)
+_bytes = defaultdict(int)
+
+_local = threading.local()
+
+
+def _endpoint():
+    return request.endpoint or 'unknown'
+
+
+def _start_request():
+    _local.stats = RequestStats()
+
+
+# first, so the queries of the other before_request functions count too
+app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+
+
+@app.after_request
+def _count_bytes(response):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.status = response.status_code
+    endpoint = _endpoint()
+    if response.is_streamed:
+        response.response = _counted(response.response, endpoint)
+    else:
+        with _lock:
+            _bytes[endpoint] += response.calculate_content_length() or 0
+    return response
+
+
+def _counted(chunks, endpoint):
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        with _lock:
+            _bytes[endpoint] += size
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+@app.teardown_request
+def _finish_request(exc):
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    if stats is None:
+        return
+    elapsed = time.perf_counter() - stats.started
+    endpoint = _endpoint()
+    status = stats.status or 500
+    with _lock:
+        _requests[(endpoint, request.method, status)] += 1
+        _latency[endpoint].observe(elapsed)
+        _queries_per_request[endpoint].observe(stats.queries)
+        _query_seconds[endpoint] += stats.query_seconds
+        _rows[endpoint] += stats.rows
+    threshold = app.config['METRICS_SLOW_REQUEST_MS']
+    if threshold is not None and elapsed * 1000 >= threshold:
+        app.logger.warning('slow request: %s %s %s in %.0f ms, %d queries in %.0f ms, %d rows',
+                           request.method, request.full_path, status, elapsed * 1000,
+                           stats.queries, stats.query_seconds * 1000, stats.rows)
+
+
+class _CountingCursor(object):
+    # a DBAPI cursor that adds the rows fetched from it to a request
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.rows += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.query_seconds += time.perf_counter() - conn.info.pop('metrics_started')
+    # the result is read from context.cursor after this event
+    if context is not None and cursor.description is not None:
+        context.cursor = _CountingCursor(cursor, stats)
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels.items()) + '}'
+
+
+def _histogram(lines, name, histograms):
+    for endpoint, h in sorted(histograms.items()):
+        for bound, count in zip(h.buckets, h.counts):
+            lines.append('{}_bucket{} {}'.format(name, _labels(endpoint=endpoint, le=bound), count))
+        lines.append('{}_bucket{} {}'.format(name, _labels(endpoint=endpoint, le='+Inf'), h.count))
+        lines.append('{}_sum{} {}'.format(name, _labels(endpoint=endpoint), h.sum))
+        lines.append('{}_count{} {}'.format(name, _labels(endpoint=endpoint), h.count))
+
+
+def render():
+    # everything, in the Prometheus text exposition format
+    from app.cache import response_cache
+    from app.ingest import write_behind_stats
+    from app.responses import response_writer_stats
+    from app.email import mail_queue_stats
+    lines = []
+    with _lock:
+        lines.append('# HELP app_requests_total Requests handled, by endpoint, method and status.')
+        lines.append('# TYPE app_requests_total counter')
+        for (endpoint, method, status), n in sorted(_requests.items()):
+            lines.append('app_requests_total{} {}'.format(
+                _labels(endpoint=endpoint, method=method, status=status), n))
+        lines.append('# HELP app_request_duration_seconds Time from the start of a request '
+                     'until its response was done.')
+        lines.append('# TYPE app_request_duration_seconds histogram')
+        _histogram(lines, 'app_request_duration_seconds', _latency)
+        lines.append('# HELP app_db_queries_per_request Database queries run by a request.')
+        lines.append('# TYPE app_db_queries_per_request histogram')
+        _histogram(lines, 'app_db_queries_per_request', _queries_per_request)
+        for name, help, values in (
+                ('app_db_query_seconds_total', 'Time spent in database queries.', _query_seconds),
+                ('app_db_rows_total', 'Rows fetched from the database.', _rows),
+                ('app_response_bytes_total', 'Response body bytes sent.', _bytes)):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} counter'.format(name))
+            for endpoint, value in sorted(values.items()):
+                lines.append('{}{} {}'.format(name, _labels(endpoint=endpoint), value))
+    cache = response_cache.stats()
+    # zeros for queues that were never needed, without starting them
+    queue = write_behind_stats() or {}
+    answers = response_writer_stats() or {}
+    mails = mail_queue_stats() or {}
+    for name, kind, help, value in (
+            ('app_response_cache_hits_total', 'counter', 'Response cache hits.', cache['hits']),
+            ('app_response_cache_misses_total', 'counter', 'Response cache misses.', cache['misses']),
+            ('app_ingest_queue_depth', 'gauge', 'Data points waiting to be written.',
+             queue.get('queue_depth', 0)),
+            ('app_ingest_rejected_total', 'counter', 'Data points turned away by a full queue.',
+             queue.get('rejected', 0)),
+            ('app_responses_queue_depth', 'gauge', 'Responses waiting to be written.',
+             answers.get('queue_depth', 0)),
+            ('app_responses_rejected_total', 'counter', 'Responses turned away by a full queue.',
+             answers.get('rejected', 0)),
+            ('app_mail_queue_depth', 'gauge', 'Emails waiting to be sent.', mails.get('queue_depth', 0)),
+            ('app_mail_sent_total', 'counter', 'Emails sent.', mails.get('sent', 0)),
+            ('app_mail_failed_total', 'counter', 'Emails given up on.', mails.get('failed', 0)),
+            ('app_mail_retries_total', 'counter', 'Emails tried again after a failure.',
+             mails.get('retried', 0)),
+            ('app_mail_connections_total', 'counter', 'SMTP connections opened.',
+             mails.get('connections', 0))):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def _allowed():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        sent = request.headers.get('Authorization', '')
+        return hmac.compare_digest(sent.encode(), 'Bearer {}'.format(token).encode())
+    return request.remote_addr in app.config['METRICS_ALLOW']
+
+
+@app.route('/metrics')
+def metrics():
+    if not _allowed():
+        return app.response_class('Not Found\n', status=404, mimetype='text/plain')
+    return app.response_class(render(), mimetype='text/plain; version=0.0.4')
@@ -1,10 +1,14 @@
+from collections import namedtuple
 from datetime import datetime
 from hashlib import md5
+import threading
 from time import time
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from app import app, db, login
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.types import JSON
 
 followers = db.Table(
@@ -104,9 +108,73 @@ class Activity(db.Model):
 
     def __repr__(self):
         return 'Activity {}: {}'.format(self.id, self.name)
-    
+
+    @staticmethod
     def exists(id):
-        return id in [a.id for a in Activity.query.all()]
+        return Activity.cached(id) is not None
+
+    @staticmethod
+    def cached(id):
+        # ActivityInfo for id, or None, without touching the database
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+        return _activity_cache().get(id)
+
+    @staticmethod
+    def all_cached():
+        return sorted(_activity_cache().values(), key=lambda a: a.id)
+
+    @staticmethod
+    def invalidate_cache():
+        global _activities, _activities_loaded_at
+        with _activities_lock:
+            _activities = None
+            _activities_loaded_at = 0
+
+
+# The NetLogo handshake (/open_activities, /check_password) and /add_data only
+# need these few columns, so we keep every activity in memory and reload them
+# after a commit that touched an Activity. Other processes' changes show up
+# within ACTIVITY_CACHE_TTL seconds.
+ActivityInfo = namedtuple('ActivityInfo', ['id', 'name', 'password', 'template', 'open_until'])
+
+_activities = None
+_activities_loaded_at = 0
+_activities_lock = threading.Lock()
+
+
+def _activity_cache():
+    global _activities, _activities_loaded_at
+    activities = _activities
+    if activities is not None and time() - _activities_loaded_at < app.config['ACTIVITY_CACHE_TTL']:
+        return activities
+    with _activities_lock:
+        if _activities is None or time() - _activities_loaded_at >= app.config['ACTIVITY_CACHE_TTL']:
+            _activities = {a.id : ActivityInfo(a.id, a.name, a.password, a.template, a.open_until)
+                           for a in Activity.query.all()}
+            _activities_loaded_at = time()
+        return _activities
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_activity_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Activity):
+            session.info['activities_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_activity_cache(session):
+    if session.info.pop('activities_changed', False):
+        Activity.invalidate_cache()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_activity_changes(session, previous_transaction):
+    session.info.pop('activities_changed', None)
 
 
 
@@ -115,4 +183,112 @@ class DataPoint(db.Model):
     data = db.Column(JSON, default = {})
     activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # copies of the fields in data that the dashboards filter and sort on,
+    # set from data by indexed_fields when the point is stored
+    users = db.Column(db.String(64))
+    measurement = db.Column(db.String(64))
+    assignment = db.Column(db.Integer)
+    attempt = db.Column(db.Float)
+
+    __table_args__ = (
+        db.Index('ix_data_point_activity_measurement_users',
+                 'activity_id', 'measurement', 'users'),
+        db.Index('ix_data_point_activity_users_assignment',
+                 'activity_id', 'users', 'assignment'),
+    )
 
+    @staticmethod
+    def indexed_fields(data):
+        # values for the indexed columns, None where data doesn't have a
+        # usable value (the dashboards skip those points)
+        fields = {}
+        for key in ('users', 'measurement'):
+            value = data.get(key)
+            fields[key] = value if isinstance(value, str) else None
+        for key, kind in (('assignment', int), ('attempt', float)):
+            try:
+                fields[key] = kind(data[key])
+            except (KeyError, TypeError, ValueError):
+                fields[key] = None
+        return fields
+
+
+@event.listens_for(DataPoint, 'before_insert')
+def _set_indexed_fields(mapper, connection, target):
+    # bulk inserts skip this, so ingest.data_point_row sets them itself
+    for key, value in DataPoint.indexed_fields(target.data or {}).items():
+        setattr(target, key, value)
+
+
+
+class ScoreAggregate(db.Model):
+    # Running count/sum/min/max of one high score metric for one student in
+    # an activity, updated as data arrives (ingest.update_score_aggregates)
+    # so /highscore reads one row per student and metric.
+    id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), index=True)
+    name = db.Column(db.String(64))
+    metric = db.Column(db.String(64))
+    count = db.Column(db.Integer, default=0)
+    total = db.Column(db.Float, default=0.0)
+    minimum = db.Column(db.Float)
+    maximum = db.Column(db.Float)
+
+    __table_args__ = (
+        db.UniqueConstraint('activity_id', 'name', 'metric'),
+    )
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @staticmethod
+    def averages(averages):
+        # a dict of averages, which NetLogo sends as a list of [metric value]
+        # pairs; None if it's neither
+        if isinstance(averages, dict):
+            return averages
+        if isinstance(averages, (list, tuple)) and \
+                all(isinstance(pair, (list, tuple)) and len(pair) == 2 for pair in averages):
+            try:
+                return dict(averages)
+            except TypeError:
+                return None
+        return None
+
+    @staticmethod
+    def scores(data):
+        # (name, {metric : value}) for a point that carries high score
+        # averages, or None
+        averages = ScoreAggregate.averages(data.get('averages'))
+        if averages is None:
+            return None
+        name = data.get('name', data.get('users'))
+        values = {k : float(v) for k, v in averages.items()
+                  if isinstance(v, (int, float)) and not isinstance(v, bool)}
+        return str(name), values
+
+
+class CatalogEntry(db.Model):
+    # One distinct value seen in an activity's data points: a data key, or a
+    # users, measurement or assignment value, as JSON text. Kept up to date
+    # on insert by app.catalog, which the dashboard selectors read instead of
+    # scanning every point.
+    id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), index=True)
+    kind = db.Column(db.String(16))
+    value = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.UniqueConstraint('activity_id', 'kind', 'value'),
+    )
+
+
+class Response(db.Model):
+    # One answer sent to /submit_response, with all its arguments in data.
+    # activity_id is set when the answer names an existing activity, so
+    # /responses/<act_id> can page through one activity's answers.
+    id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    data = db.Column(db.JSON)
@@ -0,0 +1,71 @@
+from app import app, db
+from app.models import DataPoint
+
+# Shared queries for the dashboard endpoints. The filters run in SQL, on the
+# indexed copies of users/measurement/assignment/attempt where we have them
+# and on the fields inside DataPoint.data otherwise, so only matching rows
+# come back. We still select the whole data column: pulling single fields out
+# with JSON_EXTRACT round trips numbers through SQLite's 15 digit formatting.
+
+
+def text_field(key):
+    # the raw value of a field, for comparing in SQL
+    return DataPoint.data[key].as_string()
+
+
+def _path_safe(key):
+    # SQLite JSON paths can't quote these characters
+    return '"' not in key and '\\' not in key
+
+
+def activity_points(act_id, since=None):
+    # (id, data) of the points in the activity, in id order, optionally only
+    # those stored after the point with id since
+    query = db.session.query(DataPoint.id, DataPoint.data) \
+        .filter(DataPoint.activity_id == act_id) \
+        .order_by(DataPoint.id)
+    if since is not None:
+        query = query.filter(DataPoint.id > since)
+    return query
+
+
+def export_points(act_id, since, until=None):
+    # (id, timestamp, data) of the points after since (up to until), in id
+    # order
+    query = db.session.query(DataPoint.id, DataPoint.timestamp, DataPoint.data) \
+        .filter(DataPoint.activity_id == act_id, DataPoint.id > since)
+    if until is not None:
+        query = query.filter(DataPoint.id <= until)
+    return query.order_by(DataPoint.id)
+
+
+def student_points(act_id, student, since=None):
+    # points of one student, or of everyone for "all"
+    query = activity_points(act_id, since)
+    if student != "all":
+        query = query.filter(DataPoint.users == student)
+    return query
+
+
+def measurement_points(act_id, measurement, student, since=None):
+    # points for one measurement, for one student or for "all"
+    return student_points(act_id, student, since) \
+        .filter(DataPoint.measurement == measurement)
+
+
+def replay_points(act_id, students, assignment, since=None):
+    # one group's points for an assignment, in id order (app.replay sorts
+    # them by attempt)
+    return activity_points(act_id, since) \
+        .filter(DataPoint.users == students,
+                DataPoint.assignment == assignment)
+
+
+def keyed_points(act_id, xkey, ykey):
+    # points that have both keys
+    query = activity_points(act_id)
+    for key in (xkey, ykey):
+        if _path_safe(key):
+            query = query.filter(text_field(key).isnot(None))
+    return ((id, data) for id, data in query.yield_per(app.config['JSON_STREAM_CHUNK'])
+            if xkey in data and ykey in data)
@@ -0,0 +1,89 @@
+import bisect
+import threading
+from app import app, landscape, queries
+from app.lru import LRU
+
+# Replays are read from a series per activity/students/assignment that keeps
+# the group's points sorted by attempt as they arrive, instead of querying
+# and sorting all of them on every request. Like the heatmap grids, a series
+# is cached and brought up to date with just the points stored since it was
+# last read.
+
+
+class ReplaySeries(object):
+    # the points of one group for one assignment, sorted by (attempt, id)
+
+    def __init__(self):
+        self.cursor = 0
+        self.lock = threading.Lock()
+        self._keys = []
+        self.points = []
+        # (text, bounds) of the newest 'function' in the points, if any
+        self.function = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, id, attempt, point):
+        key = (attempt, id)
+        # points mostly arrive in attempt order, so this is usually an append
+        if not self._keys or key > self._keys[-1]:
+            i = len(self._keys)
+        else:
+            i = bisect.bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self.points.insert(i, point)
+
+    def start(self, after=None):
+        # index of the first point with an attempt after after
+        if after is None:
+            return 0
+        return bisect.bisect_right(self._keys, (after, float('inf')))
+
+
+# least recently used series fall out beyond REPLAY_CACHE_SIZE
+_series = LRU('REPLAY_CACHE_SIZE')
+
+
+def _get(key):
+    return _series.setdefault(key, ReplaySeries)
+
+
+def invalidate_cache():
+    _series.clear()
+
+
+def replay(act_id, students, assignment):
+    # the up to date series; only reads the points stored since the last call
+    series = _get((int(act_id), students, int(assignment)))
+    with series.lock:
+        last = series.cursor
+        for last, d in queries.replay_points(act_id, students, assignment, series.cursor):
+            if 'function' in d:
+                series.function = (d['function'], landscape.bounds(d))
+            try:
+                attempt = float(d['attempt'])
+                point = {'x' : d['x'], 'y' : d['y'], 'attempt' : d['attempt']}
+            except (KeyError, TypeError, ValueError):
+                # nowhere to put it in the replay
+                continue
+            series.add(last, attempt, point)
+        series.cursor = max(series.cursor, last)
+    return series
+
+
+def replay_points(act_id, students, assignment, after=None):
+    # (index of the first point, points) with attempts after after, in order
+    series = replay(act_id, students, assignment)
+    with series.lock:
+        start = series.start(after)
+        return start, series.points[start:]
+
+
+def replay_landscape(act_id, students, assignment):
+    # the landscape of the group's function, see app/landscape.py
+    series = replay(act_id, students, assignment)
+    if series.function is None:
+        return None
+    text, limits = series.function
+    return landscape.landscape(act_id, int(assignment), text, limits)
@@ -0,0 +1,97 @@
+import json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from datetime import datetime
+import click
+from app import app, db
+from app.models import Activity, Response
+from app.writebehind import LazyQueue, WriteBehindQueue
+
+# Answers sent to /submit_response, stored as Response rows. Requests only
+# queue them; a background thread writes them RESPONSES_FLUSH_ROWS at a time
+# (or every RESPONSES_FLUSH_INTERVAL seconds), in one transaction per batch,
+# so several server processes can take answers at once. They are read back
+# per activity with /responses/<act_id>, using the activity_id index.
+# A batch that still can't be written after the queue's retries is appended
+# to RESPONSES_FAILED_PATH, which `flask import-responses` loads later, so
+# an answer we said OK to isn't lost.
+
+
+def response_row(args):
+    # args are the request's arguments; 'activity', if it names one, is
+    # where the answer shows up
+    try:
+        activity_id = int(float(args['activity']))
+    except (KeyError, TypeError, ValueError, OverflowError):
+        activity_id = None
+    if activity_id is not None and not Activity.exists(activity_id):
+        activity_id = None
+    return {'activity_id' : activity_id, 'timestamp' : datetime.utcnow(), 'data' : args}
+
+
+def insert_responses(rows):
+    if not rows:
+        return 0
+    db.session.bulk_insert_mappings(Response, rows)
+    db.session.commit()
+    return len(rows)
+
+
+def _flush_responses(rows):
+    with app.app_context():
+        insert_responses(rows)
+
+
+def _save_failed_responses(rows):
+    # one JSON object of arguments per line, like the old responses.txt;
+    # locked, as other processes may be doing the same
+    lines = ''.join(json.dumps(row['data']) + '\n' for row in rows)
+    with open(app.config['RESPONSES_FAILED_PATH'], 'a') as out:
+        if fcntl is not None:
+            fcntl.flock(out, fcntl.LOCK_EX)
+        out.write(lines)
+        out.flush()
+    app.logger.error('response-writer: saved %d responses to %s, load them with '
+                     'flask import-responses', len(rows), app.config['RESPONSES_FAILED_PATH'])
+
+
+response_writer = LazyQueue(lambda: WriteBehindQueue(
+    _flush_responses,
+    maxsize=app.config['RESPONSES_QUEUE_SIZE'],
+    batch_size=app.config['RESPONSES_FLUSH_ROWS'],
+    interval=app.config['RESPONSES_FLUSH_INTERVAL'],
+    name='response-writer',
+    retries=app.config['RESPONSES_FLUSH_RETRIES'],
+    failed=_save_failed_responses))
+# None if nothing was submitted yet
+response_writer_stats = response_writer.stats
+
+
+def enqueue_response(args):
+    # raises queue.Full when the writer is behind
+    response_writer().put(response_row(args))
+
+
+def responses(act_id, since=None, limit=None):
+    # (rows, cursor): an activity's answers after the id since, oldest first
+    query = db.session.query(Response.id, Response.timestamp, Response.data) \
+        .filter(Response.activity_id == act_id)
+    if since is not None:
+        query = query.filter(Response.id > since)
+    rows = query.order_by(Response.id).limit(limit).all()
+    return [{'id' : id, 'timestamp' : timestamp.isoformat(), 'data' : data}
+            for id, timestamp, data in rows], (rows[-1][0] if rows else since)
+
+
+@app.cli.command('import-responses')
+@click.argument('path', default='responses.txt')
+def import_responses_command(path):
+    """Load a responses.txt written by older versions."""
+    rows = []
+    with open(path) as lines:
+        for line in lines:
+            if line.strip():
+                rows.append(response_row(json.loads(line)))
+    click.echo('Imported {} responses from {}'.format(insert_responses(rows), path))
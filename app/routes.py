@@ -1,21 +1,29 @@
 import os
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, json, jsonify
+from flask import render_template, flash, redirect, url_for, request, json, jsonify, \
+    abort, stream_with_context, send_file
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.urls import url_parse
 from app import app, db
 from app.forms import LoginForm, RegistrationForm, EditProfileForm, \
     EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm, AddActivityForm
-from app.models import User, Post, Activity, DataPoint
+from app.models import User, Post, Activity, ScoreAggregate
 from app.email import send_password_reset_email
-import ast
+from app import logolist, queries, heatmap, export, jsonstream, columns, catalog, replay
+from app.stream import point_events
+from app.cache import cached_by_activity, response_cache
+from app.last_seen import mark_seen
+from app.ingest import parse_rows, insert_data_points, enqueue_data_point, \
+    write_behind_stats
+from app.responses import enqueue_response, responses
+from app.tokens import ingest_token, verify_ingest_token, InvalidToken
+import queue
+import tempfile
 
 
 @app.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        mark_seen(current_user)
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -185,8 +193,8 @@ def unfollow(username):
 
 @app.route('/open_activities')
 def get_open_activities():
-    activities = [[a.id, a.name] for a in Activity.query.all()]
-    nl_list  = to_logo_list_str(activities)
+    activities = [[a.id, a.name] for a in Activity.all_cached()]
+    nl_list  = logolist.dumps(activities)
     response = app.response_class(
         response=json.dumps(nl_list),
         status=200,
@@ -196,24 +204,28 @@ def get_open_activities():
 
 @app.route('/highscore/<act_id>', methods=['POST', 'GET'])
 def highscore(act_id):
-    activity = Activity.query.get(act_id)
-    averages = []
-    for point in activity.data_points:
-        user_dict = {'name' : point.data['name']}
-        user_dict.update(point.data['averages'])
-        averages.append(user_dict)
+    activity = Activity.cached(act_id)
+    if activity is None:
+        abort(404)
+    # one row per student, with the mean of each metric over their submissions
+    averages = {}
+    for agg in ScoreAggregate.query.filter_by(activity_id=activity.id).order_by(ScoreAggregate.id):
+        averages.setdefault(agg.name, {'name' : agg.name})[agg.metric] = agg.mean
+    averages = list(averages.values())
     # this is ordered, so this is how they will appear in the high score, left to right
     table_keys = ['name', 'Population', 'Food Production', 'Cows', 'Pollution', 'Avg. Lifespan', 'Temperature', 'Forest', 'Grass']
     # make sure to sort these correctly first
     table_values = []
     table_values.append(table_keys)
-    user_data = [[ inner[k] for k in table_keys] for inner in averages]
+    user_data = [[ inner.get(k) for k in table_keys] for inner in averages]
     table_values.append(list(user_data))
-    return render_template('highscore.html', activity=activity, data=averages, table_data=table_values)
+    return render_template('activity_templates/highscore.html', activity=activity, data=averages, table_data=table_values)
 
 @app.route('/activity/<act_id>', methods=['POST', 'GET'])
 def activity(act_id):
-    activity = Activity.query.get(act_id)
+    activity = Activity.cached(act_id)
+    if activity is None:
+        abort(404)
     # return render_template('activity_templates/' + 'activity.html', activity=activity)
     return render_template('activity_templates/' + activity.template, activity=activity)
 
@@ -231,45 +243,61 @@ def add_activity():
     return render_template('add_activity.html', form=form)
 
 @app.route('/get_data_keys_and_students', methods=['POST', 'GET'])
+@cached_by_activity
 def get_data_keys_and_students():
     act_id = request.args.get('act_id')
-    activity = Activity.query.get(act_id)
+    if not Activity.exists(act_id):
+        abort(404)
     ret_dict = {}
-    students = set()
-    keys = set()
-    for dp in activity.data_points:
-        for k in dp.data.keys():
-            keys.add(k)
-        students.add(dp.data['users'])
-    keys = sorted(list(keys))
-    students = sorted(list(students))
+    keys = catalog.values(act_id, 'key')
+    students = catalog.values(act_id, 'student')
     ret_dict["students"] = students
     ret_dict["keys"] = keys
     return jsonify(ret_dict)
 
 
+@app.route('/export/<act_id>')
+@login_required
+def export_activity(act_id):
+    # the activity's data points as a download, see app/export.py
+    activity = Activity.cached(act_id)
+    if activity is None:
+        abort(404)
+    format = request.args.get('format') or export.default_format()
+    try:
+        export.check_format(format)
+    except ValueError:
+        abort(400)
+    filename = 'activity_{}{}'.format(activity.id, export.EXTENSIONS[format])
+    if format == 'csv':
+        # sent as it is written
+        return app.response_class(
+            stream_with_context(export.csv_chunks(activity.id)), mimetype='application/gzip',
+            headers={'Content-Disposition' : 'attachment; filename={}'.format(filename)})
+    # written to a temporary file first, Parquet can't be written as a stream
+    out = tempfile.TemporaryFile()
+    export.export_activity(activity.id, out, format)
+    out.seek(0)
+    return send_file(out, as_attachment=True, attachment_filename=filename,
+                     mimetype='application/octet-stream')
+
+
 @app.route('/get_data_keys', methods=['POST', 'GET'])
+@cached_by_activity
 def get_data_keys():
     act_id = request.args.get('act_id')
-    activity = Activity.query.get(act_id)
-    keys = set()
-    for dp in activity.data_points:
-        for k in dp.data.keys():
-            keys.add(k)
-    keys = sorted(list(keys))
-    return jsonify(keys)
+    if not Activity.exists(act_id):
+        abort(404)
+    return jsonify(catalog.values(act_id, 'key'))
 
 @app.route('/get_students_and_assignments', methods=['POST', 'GET'])
+@cached_by_activity
 def get_students_and_assignments():
     act_id = request.args.get('act_id')
-    activity = Activity.query.get(act_id)
-    students = set() 
-    assignments = set()
-    for dp in activity.data_points:
-        assignments.add(dp.data['assignment'])
-        students.add(dp.data['users'])
-    assignments = sorted(list(assignments))
-    students = sorted(list(students))
+    if not Activity.exists(act_id):
+        abort(404)
+    assignments = catalog.values(act_id, 'assignment')
+    students = catalog.values(act_id, 'student')
     ret_list = []
     ret_list.append(students)
     ret_list.append(assignments)
@@ -280,103 +308,146 @@ def get_keyed_data():
     act_id = request.args.get('act_id')
     xkey = request.args.get('xkey')
     ykey = request.args.get('ykey')
-    activity = Activity.query.get(act_id)
-    data = []
-    for point in activity.data_points:
-        if xkey in point.data and ykey in point.data:
-            pdict = {'x' : point.data[xkey], 'y' : point.data[ykey]}
-            data.append(pdict)
-    return jsonify(data)
+    if xkey is None or ykey is None:
+        abort(400)
+    return jsonstream.points_response(queries.keyed_points(act_id, xkey, ykey), xkey, ykey)
 
 @app.route('/get_heatmap_data', methods=['POST', 'GET'])
+@columns.vary_accept
 def get_heatmap_data():
     act_id = request.args.get('act_id')
     measurement = request.args.get('measurement')
     student = request.args.get('student')
-    activity = Activity.query.get(act_id)
-    data = []
-    max_v = 0
-    for point in activity.data_points:
-        if point.data['measurement'] == measurement and (student == "all" or student == point.data['users']):
-            pdict = {'x' : point.data['x'], 'y' : point.data['y'], 'v' : point.data['v']}
-            if point.data['v'] > max_v:
-                max_v = point.data['v']
-            data.append(pdict)
+    # one square per HEATMAP_CELL_SIZE cell, coloured by the mean (or max,
+    # count, sum) of the v of the points in it
+    stat = request.args.get('stat', 'mean')
+    if stat not in heatmap.STATS:
+        abort(400)
+    # with since, only the cells that got points after that id; max_v is
+    # always over the whole grid
+    since = request.args.get('since', type=int)
+    if columns.requested():
+        grid = heatmap.heatmap(act_id, measurement, student)
+        with grid.lock:
+            x, y, v, max_v = grid.columns(stat, since)
+            meta = {'max_v' : max_v}
+            if since is not None:
+                meta['cursor'] = max(grid.cursor, since)
+        return columns.response([('x', x), ('y', y), ('v', v)], **meta)
+    if since is not None:
+        return jsonify(heatmap.heatmap_update(act_id, measurement, student, since, stat))
+    grid = heatmap.heatmap(act_id, measurement, student)
+    with grid.lock:
+        data, max_v = grid.cells(stat)
     return jsonify(data, max_v)
 
 
 @app.route('/get_measurement_data', methods=['POST', 'GET'])
+@columns.vary_accept
 def get_measurement_data():
     act_id = request.args.get('act_id')
     measurement = request.args.get('measurement')
     student = request.args.get('student')
-    activity = Activity.query.get(act_id)
-    data = []
-    for point in activity.data_points:
-        if point.data['measurement'] == measurement and (student == "all" or student == point.data['users']):
-            pdict = {'x' : point.data['x'], 'y' : point.data['y']}
-            data.append(pdict)
-    return jsonify(data)
+    since = request.args.get('since', type=int)
+    rows = queries.measurement_points(act_id, measurement, student, since) \
+        .yield_per(app.config['JSON_STREAM_CHUNK'])
+    if columns.requested():
+        cols, last = columns.from_rows(rows, ['x', 'y'])
+        if since is None:
+            return columns.response(cols)
+        return columns.response(cols, cursor=since if last is None else last)
+    return jsonstream.points_response(rows, since=since)
 
 
 @app.route('/submit_response', methods=['POST', 'GET'])
 def submit_response():
-    print(request.args.to_dict())
-    if "response" in request.args.to_dict().keys():
-        with open("responses.txt", "a") as outf:
-            outf.write(json.dumps(request.args.to_dict()))
-            outf.write("\n")
+    args = request.args.to_dict()
+    if "response" in args:
+        # written in batches by a background thread, see app/responses.py
+        try:
+            enqueue_response(args)
+        except queue.Full:
+            return(app.response_class(response=json.dumps("Server busy, try again"), status=503, mimetype='application/json'))
         return(app.response_class(response=json.dumps("OK"), status=200, mimetype='application/json'))
     else:
         return(app.response_class(response=json.dumps("didnt work"), status=400, mimetype='application/json'))
 
 
+@app.route('/responses/<act_id>')
+@login_required
+def get_responses(act_id):
+    # the activity's answers, a page at a time: pass the cursor of one page
+    # as since to get the next
+    activity = Activity.cached(act_id)
+    if activity is None:
+        abort(404)
+    data, cursor = responses(activity.id, request.args.get('since', type=int),
+                             app.config['RESPONSES_PAGE_SIZE'])
+    return jsonify({'data' : data, 'cursor' : cursor})
+
+
 @app.route('/get_measurement_keys_and_students', methods=['POST', 'GET'])
+@cached_by_activity
 def get_measurement_keys_and_students():
     act_id = request.args.get('act_id')
-    activity = Activity.query.get(act_id)
-    students = set()
-    measurements = set()
-    for dp in activity.data_points:
-        measurements.add(dp.data['measurement'])
-        students.add(dp.data['users'])
-    students = sorted(list(students))
+    if not Activity.exists(act_id):
+        abort(404)
+    students = catalog.values(act_id, 'student')
     students.append("all")
-    measurements = sorted(list(measurements))
+    measurements = catalog.values(act_id, 'measurement')
     return jsonify(measurements, students)
 
 
 @app.route('/get_replay_data', methods=['POST', 'GET'])
+@columns.vary_accept
 def get_replay_data():
     act_id = request.args.get('act_id')
     students = request.args.get('students')
-    assignment = int(request.args.get('assignment'))
-    activity = Activity.query.get(act_id)
-    data = []
-    func_string = "" # save it here so we can call it just once later
-    for point in activity.data_points: 
-        if point.data['users'] == students and int(point.data['assignment']) == assignment:
-            pdict = {'x' : point.data['x'], 'y' : point.data['y'], 'attempt' : point.data['attempt']}
-            # func_string = point.data['function']
-            data.append(pdict)
-    
-    # sorter dem nu
-    data = sorted(data, key=lambda x: x['attempt'])
+    assignment = request.args.get('assignment', type=int)
+    if assignment is None:
+        abort(400)
+    # with after, only the attempts after that one, for animating the replay
+    after = request.args.get('after', type=float)
+    # sorted by attempt in the replay series
+    first, data = replay.replay_points(act_id, students, assignment, after)
+    # the underlying function over a grid; updates with after already have it
+    ground = None if after is not None else replay.replay_landscape(act_id, students, assignment)
+    if columns.requested():
+        # the labels are just "Attempt <n>", the chart can make those
+        cols, _ = columns.from_rows(enumerate(data), ['x', 'y', 'attempt'])
+        return columns.response(cols, first=first, landscape=ground)
     # add a set of labels:
-    labels = ["Attempt " + str(n) for n in range(len(data))]
-    # get real underlying function
-    return jsonify(data, labels)
+    labels = ["Attempt " + str(n) for n in range(first, first + len(data))]
+    return jsonify(data, labels, ground)
+
+
+@app.route('/stream/<act_id>')
+def stream(act_id):
+    # Server-Sent Events with new points for an activity, optionally only for
+    # one measurement and student. kind=heatmap sends changed heatmap cells.
+    if not Activity.exists(act_id):
+        abort(404)
+    stat = None
+    if request.args.get('kind') == 'heatmap':
+        stat = request.args.get('stat', 'mean')
+        if stat not in heatmap.STATS:
+            abort(400)
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    events = point_events(int(act_id), request.args.get('measurement'),
+                          request.args.get('student'), since,
+                          stat=stat)
+    return app.response_class(stream_with_context(events), mimetype='text/event-stream',
+                              headers={'Cache-Control' : 'no-cache', 'X-Accel-Buffering' : 'no'})
 
 
 @app.route('/get_2d_data', methods=['POST', 'GET'])
 def get_2d_data():
     act_id = request.args.get('act_id')
-    activity = Activity.query.get(act_id)
-    data = []
-    for point in activity.data_points:
-        pdict = {'x' : point.data['x'], 'y' : point.data['y']}
-        data.append(pdict)
-    return jsonify(data)
+    since = request.args.get('since', type=int)
+    rows = queries.activity_points(act_id, since).yield_per(app.config['JSON_STREAM_CHUNK'])
+    return jsonstream.points_response(rows, since=since)
 
 @app.route('/test', methods=['POST','GET'])
 def test():
@@ -384,7 +455,7 @@ def test():
 
 ## TODO: move this to a utils class
 def to_json(astr):
-    alist = ast.literal_eval(astr)
+    alist = logolist.loads(astr)
     cleaned_data = {sublist[0] : sublist[1] for sublist in alist}
     avgs = {}
     for k,v in cleaned_data.items() :
@@ -395,11 +466,30 @@ def to_json(astr):
 
 
 def combine_nl_keys_and_data(keys, values):
-    ks = ast.literal_eval(keys)
-    vs = ast.literal_eval(values)
+    ks = logolist.loads(keys)
+    vs = logolist.loads(values)
     if len(ks) == len(vs):
         return (True, {ks[n] : vs[n] for n in range(len(ks))})
-    return (false, None)
+    return (False, None)
+
+def check_token(args):
+    # For requests with a token from /check_password: sets activity and users
+    # in args from it, or returns an error response if it's no good or for
+    # someone else.
+    if 'token' not in args:
+        return None
+    try:
+        activity_id, users = verify_ingest_token(args['token'])
+    except InvalidToken as e:
+        return(app.response_class(response=json.dumps(str(e)), status=401, mimetype='application/json'))
+    try:
+        other = 'activity' in args and int(float(args['activity'])) != activity_id
+    except ValueError:
+        other = True
+    if other or args.get('users', users) != users:
+        return(app.response_class(response=json.dumps("Token is for another activity or student"), status=403, mimetype='application/json'))
+    args.update({'activity' : str(activity_id), 'users' : users})
+
 
 @app.route('/add_data', methods=['POST', 'GET', 'PUT'])
 def add_data_point():
@@ -409,47 +499,80 @@ def add_data_point():
     # keys (as a string)
     # values (as a string)
     # keys and values must have same length or we return 400
+    # or a token from /check_password instead of users and activity
     args = request.args.to_dict()
+    # the token's activity was checked when it was made
+    trusted = 'token' in args
+    error = check_token(args)
+    if error is not None:
+        return error
     if 'activity' in args:
         activity_id = int(float(args['activity']))
-        if Activity.exists(activity_id):
+        if trusted or Activity.exists(activity_id):
             jargs = combine_nl_keys_and_data(args['keys'], args['values'])
             if jargs[0]:
                 data = jargs[1]
                 data.update({'users' : args['users']})
-                dp = DataPoint(data = data, activity_id = activity_id)
-                db.session.add(dp)
-                db.session.commit()
+                if app.config['INGEST_WRITE_BEHIND']:
+                    try:
+                        enqueue_data_point(activity_id, data)
+                    except queue.Full:
+                        return(app.response_class(response=json.dumps("Server busy, try again"), status=503, mimetype='application/json'))
+                    return(app.response_class(response=json.dumps("OK"), status=200, mimetype='application/json'))
+                insert_data_points(activity_id, [data])
                 return(app.response_class(response=json.dumps("OK"), status=200, mimetype='application/json'))
             else:
                 return(app.response_class(response=json.dumps("Length of keys and values did not match"), status=400, mimetype='application/json'))
         else:
             return(app.response_class(response=json.dumps("Activity doesnt exist"), status=400, mimetype='application/json'))
 
-def to_logo_list_str(alist):
-    ret_str = ""
-    for char in str(alist):
-        if char == "(":
-            ret_str = ret_str + "["
-        elif char == ")":
-            ret_str = ret_str + "]"
-        elif char == ",":
-            ret_str = ret_str + " "
-        elif char == "'":
-            ret_str = ret_str + '"'
-        else:
-            ret_str = ret_str + char
-    return(ret_str)
-        
-
+@app.route('/add_data_batch', methods=['POST', 'GET', 'PUT'])
+def add_data_batch():
+    # like add_data, but many rows for one activity in a single request:
+    # users string
+    # activity int
+    # keys (as a string) shared by all rows
+    # rows (as a string) a list of values lists, one per data point
+    # rows whose length doesn't match keys are reported by index and skipped
+    # or a token from /check_password instead of users and activity
+    args = request.values.to_dict()
+    trusted = 'token' in args
+    error = check_token(args)
+    if error is not None:
+        return error
+    if any(key not in args for key in ('users', 'activity', 'keys', 'rows')):
+        return(app.response_class(response=json.dumps("users, activity, keys and rows are required"), status=400, mimetype='application/json'))
+    activity_id = int(float(args['activity']))
+    if not trusted and not Activity.exists(activity_id):
+        return(app.response_class(response=json.dumps("Activity doesnt exist"), status=400, mimetype='application/json'))
+    try:
+        datas, errors = parse_rows(args['keys'], args['rows'])
+    except ValueError:
+        return(app.response_class(response=json.dumps("Could not parse keys or rows"), status=400, mimetype='application/json'))
+    for data in datas:
+        data.update({'users' : args['users']})
+    inserted = insert_data_points(activity_id, datas)
+    return(app.response_class(response=json.dumps({'inserted' : inserted, 'errors' : errors}), status=200, mimetype='application/json'))
+
+@app.route('/ingest_stats')
+def ingest_stats():
+    # empty until the write-behind queue is used
+    return jsonify(write_behind_stats() or {})
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(response_cache.stats())
 
 @app.route('/check_password', methods=['GET'])
 def check_password():
     act_id = request.args.get('activity', type=float)
     act_id = int(act_id)
     password = request.args.get('password', type=str)
-    activity = Activity.query.get(act_id)
-    pw_check = password == activity.password
+    activity = Activity.cached(act_id)
+    pw_check = activity is not None and password == activity.password
+    # with token and users, a token for /add_data instead of true
+    if pw_check and request.args.get('token') and request.args.get('users'):
+        pw_check = ingest_token(act_id, request.args['users'])
     response = app.response_class(
         response=json.dumps(pw_check),
         status=200,
@@ -0,0 +1,52 @@
+// Reads the binary column responses of the chart endpoints (format=columns),
+// see app/columns.py for the layout.
+
+function decode_columns(buffer) {
+    var view = new DataView(buffer);
+    var header_length = view.getUint32(0, true);
+    var header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, header_length)));
+    var offset = 4 + header_length;
+    header.data = {};
+    for (var i = 0; i < header.columns.length; i++) {
+        // typed arrays use the machine's byte order, which in browsers is
+        // little endian everywhere we care about
+        header.data[header.columns[i]] = new Float64Array(buffer, offset, header.count);
+        offset += 8 * header.count;
+    }
+    return header;
+}
+
+// the columns back as a list of {name : value} objects, for Chart.js, which
+// takes nothing else; most of what decoding saves over JSON.parse is spent here
+function column_points(decoded) {
+    var points = new Array(decoded.count);
+    var names = decoded.columns;
+    for (var i = 0; i < decoded.count; i++) {
+        var point = {};
+        for (var j = 0; j < names.length; j++) {
+            point[names[j]] = decoded.data[names[j]][i];
+        }
+        points[i] = point;
+    }
+    return points;
+}
+
+// like $.get, but asks for columns and resolves with decode_columns
+function get_columns(url, params) {
+    var deferred = $.Deferred();
+    var request = new XMLHttpRequest();
+    request.open("GET", url + "?" + $.param($.extend({format : "columns"}, params)));
+    request.responseType = "arraybuffer";
+    request.onload = function() {
+        if (request.status === 200) {
+            deferred.resolve(decode_columns(request.response));
+        } else {
+            deferred.reject(request);
+        }
+    };
+    request.onerror = function() {
+        deferred.reject(request);
+    };
+    request.send();
+    return deferred.promise();
+}
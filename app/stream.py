@@ -0,0 +1,78 @@
+import threading
+from flask import json
+from app import app, db, queries
+from app.ingest import data_points_added
+from app.heatmap import heatmap_update
+
+
+class ActivityVersions(object):
+    # A counter per activity that goes up every time points are committed
+    # for it, and a way to sleep until it does.
+
+    def __init__(self):
+        self._versions = {}
+        self._changed = threading.Condition()
+
+    def get(self, activity_id):
+        return self._versions.get(int(activity_id), 0)
+
+    def bump(self, activity_ids):
+        with self._changed:
+            for activity_id in activity_ids:
+                activity_id = int(activity_id)
+                self._versions[activity_id] = self._versions.get(activity_id, 0) + 1
+            self._changed.notify_all()
+
+    def wait(self, activity_id, seen, timeout):
+        # returns the current version once it differs from seen, or after
+        # timeout seconds
+        with self._changed:
+            self._changed.wait_for(lambda: self.get(activity_id) != seen, timeout)
+            return self.get(activity_id)
+
+
+versions = ActivityVersions()
+
+
+@data_points_added.connect_via(app)
+def _bump_versions(sender, activity_ids):
+    versions.bump(activity_ids)
+
+
+def _points(act_id, measurement, student, since, stat):
+    if stat is not None:
+        message = heatmap_update(act_id, measurement, student or "all", since, stat)
+        db.session.remove()
+        return message
+    if measurement is None:
+        rows = queries.student_points(act_id, student or "all", since)
+    else:
+        rows = queries.measurement_points(act_id, measurement, student or "all", since)
+    data = []
+    cursor = since
+    for cursor, d in rows:
+        if 'x' in d and 'y' in d:
+            data.append({'x' : d['x'], 'y' : d['y']})
+    db.session.remove()
+    return {'data' : data, 'cursor' : cursor}
+
+
+def point_events(act_id, measurement, student, since, stat=None):
+    # Server-Sent Events with the points stored after since, in the same
+    # shape as the polling endpoints' since responses. Each event's id is
+    # the cursor, so a reconnecting EventSource picks up where it left off.
+    # With a stat, the events carry the heatmap cells that changed instead.
+    # We check the database whenever this process stores points for the
+    # activity, and every STREAM_HEARTBEAT seconds for points stored by
+    # other processes.
+    heartbeat = app.config['STREAM_HEARTBEAT']
+    seen = versions.get(act_id)
+    yield 'retry: 2000\n\n'
+    while True:
+        message = _points(act_id, measurement, student, since, stat)
+        if message['data']:
+            since = message['cursor']
+            yield 'id: {}\ndata: {}\n\n'.format(since, json.dumps(message))
+        else:
+            yield ': keepalive\n\n'
+        seen = versions.wait(act_id, seen, heartbeat)
@@ -0,0 +1,31 @@
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from app import app
+
+# Signed tokens for ingest clients. /check_password hands one out (when asked
+# with token=1 and users) for the activity and student, and /add_data and
+# /add_data_batch take it instead of activity and users. Checking one needs
+# only SECRET_KEY, no database, and they expire after INGEST_TOKEN_TTL
+# seconds, so clients left running from an old class get turned away.
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def _serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='ingest')
+
+
+def ingest_token(activity_id, users):
+    return _serializer().dumps({'activity' : int(activity_id), 'users' : users})
+
+
+def verify_ingest_token(token):
+    # (activity_id, users), or raises InvalidToken
+    try:
+        payload = _serializer().loads(token, max_age=app.config['INGEST_TOKEN_TTL'])
+    except SignatureExpired:
+        raise InvalidToken('Token expired, check the password again')
+    except BadSignature:
+        raise InvalidToken('Invalid token')
+    return payload['activity'], payload['users']
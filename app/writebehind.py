@@ -0,0 +1,185 @@
+import atexit
+import queue
+import threading
+import time
+from app import app
+
+
+class WriteBehindQueue(object):
+    # A bounded in-process queue drained by one background thread. Items are
+    # handed to `flush` in batches of up to `batch_size`, or whatever has
+    # arrived `interval` seconds after the first item of a batch was taken.
+    # `put` raises queue.Full instead of blocking, so callers can push back,
+    # and after close(). A batch whose flush raises is tried `retries` more
+    # times, `retry_delay` seconds apart and then twice as long each time,
+    # before it is handed to `failed` (if given) and counted as failed.
+
+    def __init__(self, flush, maxsize=10000, batch_size=500, interval=0.5,
+                 name='write-behind', retries=3, retry_delay=0.5, failed=None):
+        self._flush = flush
+        self._failed = failed
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize)
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.interval = interval
+        self.name = name
+        self._thread = None
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.flushes = 0
+        self.items_written = 0
+        self.items_failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        atexit.register(self.close)
+
+    def put(self, item):
+        if self._stopping.is_set():
+            # nothing would write it
+            self.rejected += 1
+            raise queue.Full
+        self._start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.rejected += 1
+            raise
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        # write everything queued so far on the calling thread
+        while True:
+            batch = self._take(block=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            'queue_depth' : self.depth(),
+            'queue_capacity' : self.maxsize,
+            'flushes' : self.flushes,
+            'items_written' : self.items_written,
+            'items_failed' : self.items_failed,
+            'retried' : self.retried,
+            'rejected' : self.rejected,
+            'last_flush_ms' : self.last_flush_seconds * 1000,
+            'max_flush_ms' : self.max_flush_seconds * 1000,
+            'mean_flush_ms' : (self.total_flush_seconds / self.flushes * 1000) if self.flushes else 0.0,
+        }
+
+    def _start(self):
+        if self._thread is not None or self._stopping.is_set():
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name,
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take(block=True)
+            if batch:
+                self._write(batch)
+
+    def _take(self, block):
+        batch = []
+        try:
+            if block:
+                # wake up now and then to notice close()
+                batch.append(self._queue.get(timeout=0.1))
+            else:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + (self.interval if block else 0)
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            # short waits, so close() doesn't have to sit out the interval
+            waiting = remaining > 0 and not self._stopping.is_set()
+            try:
+                if waiting:
+                    batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                if not waiting:
+                    break
+        return batch
+
+    def _write(self, batch):
+        with self._write_lock:
+            start = time.perf_counter()
+            for attempt in range(self.retries + 1):
+                try:
+                    self._flush(batch)
+                    break
+                except Exception:
+                    if attempt == self.retries:
+                        self.items_failed += len(batch)
+                        app.logger.exception('%s: failed to write %d items', self.name, len(batch))
+                        if self._failed is not None:
+                            try:
+                                self._failed(batch)
+                            except Exception:
+                                app.logger.exception('%s: could not hand off %d failed items',
+                                                     self.name, len(batch))
+                        return
+                    self.retried += 1
+                    app.logger.warning('%s: failed to write %d items, trying again',
+                                       self.name, len(batch), exc_info=True)
+                    time.sleep(self.retry_delay * 2 ** attempt)
+            elapsed = time.perf_counter() - start
+            self.flushes += 1
+            self.items_written += len(batch)
+            self.last_flush_seconds = elapsed
+            self.total_flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+
+class LazyQueue(object):
+    # A queue that `make` creates the first time it is needed, so its
+    # settings can come from app.config. Calling this returns the queue;
+    # stats() is None until then, so reading them doesn't start threads.
+
+    def __init__(self, make):
+        self._make = make
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if self._queue is None:
+            with self._lock:
+                if self._queue is None:
+                    self._queue = self._make()
+        return self._queue
+
+    def current(self):
+        # the queue, or None if it wasn't needed yet
+        return self._queue
+
+    def replace(self, new):
+        # puts new (or None, to make one on next use) in place of the
+        # queue and returns the old one
+        with self._lock:
+            old, self._queue = self._queue, new
+        return old
+
+    def stats(self):
+        q = self._queue
+        return q.stats() if q is not None else None
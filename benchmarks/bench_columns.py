@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# Compares the size of get_measurement_data responses as JSON and in the
+# columns format, and how long it takes to turn them into the list of
+# {x, y} points the charts are given: json.loads against numpy.frombuffer
+# plus building the points, standing in for JSON.parse against
+# Float64Array plus column_points() in app/static/columns.js.
+#
+#   python benchmarks/bench_columns.py
+import json
+import os
+import random
+import struct
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import columns
+
+
+def decode(body):
+    size, = struct.unpack('<I', body[:4])
+    header = json.loads(body[4:4 + size])
+    offset = 4 + size
+    data = {}
+    for name in header['columns']:
+        data[name] = np.frombuffer(body, '<f8', header['count'], offset)
+        offset += 8 * header['count']
+    return data
+
+
+def points(body):
+    # like column_points: Chart.js wants an object per point
+    data = decode(body)
+    names = list(data)
+    return [dict(zip(names, values)) for values in zip(*(data[name].tolist() for name in names))]
+
+
+def best_of(func, arg, number):
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+
+
+def main():
+    rng = random.Random(1)
+    print('{:<10} {:>12} {:>12} {:>7} {:>14} {:>14} {:>8}'.format(
+        'points', 'json bytes', 'cols bytes', 'ratio', 'json us', 'cols us', 'speedup'))
+    for n in (100, 1000, 10000, 100000):
+        rows = [(i, {'x': rng.uniform(-200, 200), 'y': rng.uniform(-200, 200)})
+                for i in range(n)]
+        as_json = json.dumps([{'x': d['x'], 'y': d['y']} for _, d in rows],
+                             separators=(',', ':')).encode()
+        cols, _ = columns.from_rows(rows, ['x', 'y'])
+        as_columns = columns.pack(cols)
+        number = max(1, 100000 // n)
+        before = best_of(json.loads, as_json, number)
+        after = best_of(points, as_columns, number)
+        assert points(as_columns) == json.loads(as_json)
+        print('{:<10} {:>12} {:>12} {:>6.1f}x {:>14.1f} {:>14.1f} {:>7.1f}x'.format(
+            n, len(as_json), len(as_columns), len(as_json) / len(as_columns),
+            before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
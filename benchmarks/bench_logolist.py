@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Compares app.logolist against what the routes used before it, on payloads
+# shaped like what NetLogo models send to /add_data and /add_data_batch.
+#
+#   python benchmarks/bench_logolist.py
+import ast
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import logolist
+
+
+def payloads():
+    rng = random.Random(1)
+    for n in (10, 100, 1000, 10000):
+        yield 'keys x{}'.format(n), repr(['key{}'.format(i) for i in range(n)])
+        yield 'floats x{}'.format(n), repr([rng.uniform(-100, 100) for _ in range(n)])
+        yield 'ints x{}'.format(n), repr([rng.randrange(1000) for _ in range(n)])
+    rows = [[rng.uniform(0, 30), rng.uniform(0, 30), rng.random(), 'heat']
+            for _ in range(1000)]
+    yield 'rows 1000x4', repr(rows)
+
+
+def best_of(func, arg, number):
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+
+
+def main():
+    print('{:<16} {:>14} {:>14} {:>8}'.format('payload', 'literal_eval us', 'loads us', 'speedup'))
+    for name, text in payloads():
+        assert logolist.loads(text) == ast.literal_eval(text)
+        number = max(1, 200000 // len(text))
+        before = best_of(ast.literal_eval, text, number)
+        after = best_of(logolist.loads, text, number)
+        print('{:<16} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(
+            name, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# Compares app.logolist.dumps against the to_logo_list_str function that
+# /open_activities used before, on activity lists of growing size.
+#
+#   python benchmarks/bench_logolist_dumps.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app import logolist
+
+
+def to_logo_list_str(alist):
+    # the old implementation, kept here for comparison
+    ret_str = ""
+    for char in str(alist):
+        if char == "(":
+            ret_str = ret_str + "["
+        elif char == ")":
+            ret_str = ret_str + "]"
+        elif char == ",":
+            ret_str = ret_str + " "
+        elif char == "'":
+            ret_str = ret_str + '"'
+        else:
+            ret_str = ret_str + char
+    return(ret_str)
+
+
+def best_of(func, arg, number):
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+
+
+def main():
+    print('{:<12} {:>18} {:>12} {:>8}'.format('activities', 'to_logo_list_str us', 'dumps us', 'speedup'))
+    for n in (10, 100, 1000, 10000, 100000):
+        activities = [[i, 'Aktivitet nummer {}'.format(i)] for i in range(n)]
+        number = max(1, 20000 // n)
+        before = best_of(to_logo_list_str, activities, number)
+        after = best_of(logolist.dumps, activities, number)
+        print('{:<12} {:>18.1f} {:>12.1f} {:>7.1f}x'.format(
+            n, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# Load test: a classroom of NetLogo clients and a few dashboards against the
+# app, served by a threaded werkzeug server on a temporary SQLite database.
+# Each student runs the base model's handshake (/open_activities, then
+# /check_password) and then submits points with /add_data like
+# submit-dictionary does; each dashboard polls the chart endpoints with since
+# cursors like the chart pages do. Prints throughput and latency percentiles
+# per endpoint, and the time spent waiting on the database for writes, and
+# saves them as JSON so runs can be compared.
+#
+#   python benchmarks/loadtest.py --students 30 --dashboards 5 --duration 20
+#   python benchmarks/loadtest.py --compare benchmarks/results/loadtest-<earlier>.json
+#
+# Settings from config.py can be changed through the environment as usual,
+# e.g. INGEST_WRITE_BEHIND=1 python benchmarks/loadtest.py
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PASSWORD = 'loadtest'
+# settings worth keeping next to the numbers
+CONFIG_KEYS = ['SQLALCHEMY_DATABASE_URI', 'DATABASE_PROFILE', 'INGEST_WRITE_BEHIND', 'INGEST_FLUSH_ROWS',
+               'INGEST_FLUSH_INTERVAL', 'RESPONSE_CACHE_TTL', 'HEATMAP_CELL_SIZE']
+
+
+def percentile(values, p):
+    # nearest rank, values sorted
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def summary(seconds):
+    ms = sorted(s * 1000 for s in seconds)
+    return {
+        'count' : len(ms),
+        'mean_ms' : sum(ms) / len(ms) if ms else None,
+        'p50_ms' : percentile(ms, 50),
+        'p95_ms' : percentile(ms, 95),
+        'p99_ms' : percentile(ms, 99),
+        'max_ms' : ms[-1] if ms else None,
+    }
+
+
+class Recorder(object):
+    # request latencies and failures per endpoint, from all client threads
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def get(self, base, path, **params):
+        url = base + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=60) as response:
+                body = response.read()
+        except urllib.error.HTTPError as e:
+            self.errors[path][str(e.code)] += 1
+            return None
+        except OSError as e:
+            self.errors[path][type(e).__name__] += 1
+            return None
+        self.latencies[path].append(time.perf_counter() - start)
+        return body
+
+
+class DatabaseWaits(object):
+    # Time spent in INSERT/UPDATE statements and in commits. With SQLite's
+    # one writer at a time, that is mostly waiting for the write lock.
+
+    def __init__(self):
+        self.statements = []
+        self.commits = []
+
+    def install(self, engine):
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info['loadtest_started'] = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                self.statements.append(time.perf_counter() - conn.info['loadtest_started'])
+
+        @event.listens_for(Session, 'before_commit')
+        def before_commit(session):
+            session.info['loadtest_commit'] = time.perf_counter()
+
+        @event.listens_for(Session, 'after_commit')
+        def after_commit(session):
+            started = session.info.pop('loadtest_commit', None)
+            if started is not None:
+                self.commits.append(time.perf_counter() - started)
+
+    def results(self):
+        return {
+            'write_statements' : summary(self.statements),
+            'commits' : summary(self.commits),
+            'total_wait_s' : sum(self.statements) + sum(self.commits),
+        }
+
+
+def student(recorder, base, act_id, n, deadline, think, rng):
+    recorder.get(base, '/open_activities')
+    recorder.get(base, '/check_password', activity=act_id, password=PASSWORD)
+    users = 'group {}'.format(n)
+    attempt = 0
+    while time.monotonic() < deadline:
+        attempt += 1
+        values = '[{} {} {} "{}" {} {}]'.format(
+            rng.uniform(0, 30), rng.uniform(0, 30), rng.randrange(100),
+            rng.choice(['heat', 'food']), rng.randrange(1, 4), attempt)
+        recorder.get(base, '/add_data', users=users, activity=act_id,
+                     keys='["x" "y" "v" "measurement" "assignment" "attempt"]',
+                     values=values)
+        time.sleep(rng.expovariate(1.0 / think) if think > 0 else 0)
+
+
+def dashboard(recorder, base, act_id, deadline, interval, rng):
+    recorder.get(base, '/get_measurement_keys_and_students', act_id=act_id)
+    measurement = rng.choice(['heat', 'food'])
+    cursors = {'/get_measurement_data' : 0, '/get_heatmap_data' : 0}
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        for path in cursors:
+            body = recorder.get(base, path, act_id=act_id, measurement=measurement,
+                                student='all', since=cursors[path])
+            if body is not None:
+                cursors[path] = json.loads(body)['cursor'] or cursors[path]
+        recorder.get(base, '/get_measurement_keys_and_students', act_id=act_id)
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, workdir):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'loadtest.db')
+    # the app writes its log to ./logs
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from werkzeug.serving import make_server
+    from app import app, db
+    from app.models import Activity, DataPoint
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    with app.app_context():
+        db.create_all()
+        activity = Activity(name='Load test', password=PASSWORD, template='activity.html')
+        db.session.add(activity)
+        db.session.commit()
+        act_id = activity.id
+        waits = DatabaseWaits()
+        waits.install(db.engine)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    started_at = datetime.utcnow().isoformat() + 'Z'
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=student, args=(recorder, base, act_id, n, deadline,
+                                                      args.think, random.Random(rng.random())))
+               for n in range(args.students)]
+    threads += [threading.Thread(target=dashboard, args=(recorder, base, act_id, deadline,
+                                                         args.poll, random.Random(rng.random())))
+                for _ in range(args.dashboards)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    with app.app_context():
+        if app.config['INGEST_WRITE_BEHIND']:
+            from app.ingest import write_behind_queue
+            write_behind_queue().flush()
+        stored = DataPoint.query.filter_by(activity_id=act_id).count()
+
+    endpoints = {}
+    for path in sorted(set(recorder.latencies) | set(recorder.errors)):
+        stats = summary(recorder.latencies[path])
+        stats['per_second'] = stats['count'] / elapsed
+        stats['errors'] = dict(recorder.errors[path])
+        endpoints[path] = stats
+    ok = sum(len(v) for v in recorder.latencies.values())
+    return {
+        'started_at' : started_at,
+        'revision' : git_revision(),
+        'python' : platform.python_version(),
+        'parameters' : {'students' : args.students, 'dashboards' : args.dashboards,
+                        'duration' : args.duration, 'think' : args.think,
+                        'poll' : args.poll, 'seed' : args.seed},
+        'config' : {key : app.config.get(key) for key in CONFIG_KEYS},
+        'elapsed_s' : elapsed,
+        'requests_per_second' : ok / elapsed,
+        'errors' : sum(sum(e.values()) for e in recorder.errors.values()),
+        'points_stored' : stored,
+        'all' : summary([s for v in recorder.latencies.values() for s in v]),
+        'endpoints' : endpoints,
+        'database' : waits.results(),
+    }
+
+
+def fmt(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+def report(results):
+    print('{:<38} {:>7} {:>8} {:>8} {:>8} {:>8} {:>7}'.format(
+        'endpoint', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for path, stats in results['endpoints'].items():
+        print('{:<38} {:>7} {:>8} {:>8} {:>8} {:>8} {:>7}'.format(
+            path, stats['count'], fmt(stats['per_second']), fmt(stats['p50_ms']),
+            fmt(stats['p95_ms']), fmt(stats['p99_ms']), sum(stats['errors'].values())))
+    total = results['all']
+    print('{:<38} {:>7} {:>8} {:>8} {:>8} {:>8} {:>7}'.format(
+        'all', total['count'], fmt(results['requests_per_second']), fmt(total['p50_ms']),
+        fmt(total['p95_ms']), fmt(total['p99_ms']), results['errors']))
+    database = results['database']
+    print('points stored: {}'.format(results['points_stored']))
+    print('database writes: {} statements p95 {} ms, {} commits p95 {} ms, {:.2f} s in total'.format(
+        database['write_statements']['count'], fmt(database['write_statements']['p95_ms']),
+        database['commits']['count'], fmt(database['commits']['p95_ms']),
+        database['total_wait_s']))
+
+
+def compare(before, after):
+    # p95 and throughput of this run against an earlier one
+    print('\ncompared to {} ({})'.format(before.get('revision'), before.get('started_at')))
+    print('{:<38} {:>10} {:>10} {:>10} {:>10}'.format(
+        'endpoint', 'req/s was', 'req/s now', 'p95 was', 'p95 now'))
+    rows = [(path, before['endpoints'].get(path, {}), stats)
+            for path, stats in after['endpoints'].items()]
+    rows.append(('all', dict(before['all'], per_second=before['requests_per_second']),
+                 dict(after['all'], per_second=after['requests_per_second'])))
+    for path, was, now in rows:
+        print('{:<38} {:>10} {:>10} {:>10} {:>10}'.format(
+            path, fmt(was.get('per_second')), fmt(now.get('per_second')),
+            fmt(was.get('p95_ms')), fmt(now.get('p95_ms'))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--students', type=int, default=30, help='NetLogo clients')
+    parser.add_argument('--dashboards', type=int, default=5, help='polling chart pages')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to run')
+    parser.add_argument('--think', type=float, default=0.2,
+                        help='mean seconds between a student\'s submissions')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between dashboard polls')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='where to save the results (default '
+                        'benchmarks/results/loadtest-<time>.json)')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results',
+        'loadtest-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    output = os.path.abspath(output)
+    before = None
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        results = run(args, workdir)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+    report(results)
+    if before is not None:
+        compare(before, results)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('\nsaved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
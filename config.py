@@ -1,4 +1,5 @@
 import os
+from sqlalchemy.pool import QueuePool
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -7,10 +8,92 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # DATABASE_PROFILE=wal tunes SQLite for many readers and one writer: a
+    # WAL journal, so reads don't block the writer, fsync only at
+    # checkpoints, waiting for the write lock instead of failing, a bigger
+    # page cache and memory mapped reads, set on each connection by
+    # app/database.py; and a pool of connections that are kept open
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE')
+    SQLITE_PRAGMAS = {}
+    if DATABASE_PROFILE == 'wal':
+        SQLITE_PRAGMAS = {
+            'journal_mode' : 'wal',
+            'synchronous' : 'normal',
+            'busy_timeout' : int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 10000),
+            'cache_size' : -32000,
+            'mmap_size' : 256 * 1024 * 1024,
+        }
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'poolclass' : QueuePool,
+            'pool_size' : int(os.environ.get('DATABASE_POOL_SIZE') or 20),
+            'max_overflow' : 20,
+            'connect_args' : {'check_same_thread' : False},
+        }
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    # outgoing mail is queued and sent by MAIL_WORKERS threads, see app/email.py
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 50)
+    MAIL_RETRIES = int(os.environ.get('MAIL_RETRIES') or 3)
+    MAIL_RETRY_DELAY = float(os.environ.get('MAIL_RETRY_DELAY') or 1)
+    # seconds an idle worker keeps its SMTP connection open
+    MAIL_IDLE_TIMEOUT = float(os.environ.get('MAIL_IDLE_TIMEOUT') or 30)
+    # seconds sending waits for room in a full queue before giving up
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 0)
     POSTS_PER_PAGE = 25
+    ACTIVITY_CACHE_TTL = float(os.environ.get('ACTIVITY_CACHE_TTL') or 30)
+    # only write a user's last_seen when it is this many seconds old
+    LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL') or 300)
+    LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 5)
+    # heatmaps are binned into square cells of this size
+    HEATMAP_CELL_SIZE = float(os.environ.get('HEATMAP_CELL_SIZE') or 1)
+    HEATMAP_CACHE_SIZE = int(os.environ.get('HEATMAP_CACHE_SIZE') or 256)
+    # log requests that take longer than this many milliseconds
+    METRICS_SLOW_REQUEST_MS = float(os.environ['METRICS_SLOW_REQUEST_MS']) \
+        if os.environ.get('METRICS_SLOW_REQUEST_MS') else None
+    # addresses that may read /metrics; behind a reverse proxy every request
+    # comes from the proxy, so set METRICS_TOKEN instead, which scrapers send
+    # as "Authorization: Bearer <token>" and which then is required from all
+    METRICS_ALLOW = ['127.0.0.1', '::1']
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # seconds before the in-memory catalog of an activity is reloaded
+    CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL') or 30)
+    # cached selector responses, see app/cache.py
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE') or 512)
+    RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL') or 10)
+    # rows fetched, and points written, at a time by the streamed JSON endpoints
+    JSON_STREAM_CHUNK = int(os.environ.get('JSON_STREAM_CHUNK') or 1000)
+    # replay series kept in memory, see app/replay.py
+    REPLAY_CACHE_SIZE = int(os.environ.get('REPLAY_CACHE_SIZE') or 256)
+    # replay landscapes: evaluated over LANDSCAPE_RANGE (unless the point
+    # with the function has xmin/xmax/ymin/ymax) in LANDSCAPE_STEPS steps
+    LANDSCAPE_RANGE = (float(os.environ.get('LANDSCAPE_MIN') or -200),
+                       float(os.environ.get('LANDSCAPE_MAX') or 200))
+    LANDSCAPE_STEPS = int(os.environ.get('LANDSCAPE_STEPS') or 100)
+    LANDSCAPE_CACHE_SIZE = int(os.environ.get('LANDSCAPE_CACHE_SIZE') or 64)
+    # data points read per query when exporting an activity
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or 5000)
+    # seconds between keepalives (and database checks) on /stream
+    STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT') or 15)
+    # queue /add_data rows in memory and write them in the background
+    INGEST_WRITE_BEHIND = os.environ.get('INGEST_WRITE_BEHIND') is not None
+    INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE') or 10000)
+    INGEST_FLUSH_ROWS = int(os.environ.get('INGEST_FLUSH_ROWS') or 500)
+    INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL') or 0.5)
+    # times a failed batch is tried again before its rows are given up on
+    INGEST_FLUSH_RETRIES = int(os.environ.get('INGEST_FLUSH_RETRIES') or 3)
+    # seconds the /check_password tokens for /add_data are good for
+    INGEST_TOKEN_TTL = int(os.environ.get('INGEST_TOKEN_TTL') or 8 * 3600)
+    # /submit_response answers are always written behind, see app/responses.py
+    RESPONSES_QUEUE_SIZE = int(os.environ.get('RESPONSES_QUEUE_SIZE') or 10000)
+    RESPONSES_FLUSH_ROWS = int(os.environ.get('RESPONSES_FLUSH_ROWS') or 500)
+    RESPONSES_FLUSH_INTERVAL = float(os.environ.get('RESPONSES_FLUSH_INTERVAL') or 0.5)
+    RESPONSES_FLUSH_RETRIES = int(os.environ.get('RESPONSES_FLUSH_RETRIES') or 5)
+    # where answers go that couldn't be stored (flask import-responses reads it)
+    RESPONSES_FAILED_PATH = os.environ.get('RESPONSES_FAILED_PATH') or 'responses_failed.txt'
+    RESPONSES_PAGE_SIZE = int(os.environ.get('RESPONSES_PAGE_SIZE') or 1000)
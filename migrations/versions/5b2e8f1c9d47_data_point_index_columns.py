@@ -0,0 +1,109 @@
+"""data point index columns
+
+Revision ID: 5b2e8f1c9d47
+Revises: ae346256b650
+Create Date: 2026-10-17 18:20:11.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8f1c9d47'
+down_revision = 'ae346256b650'
+branch_labels = None
+depends_on = None
+
+
+def indexed_fields(data):
+    # same as DataPoint.indexed_fields at the time of this migration
+    fields = {}
+    for key in ('users', 'measurement'):
+        value = data.get(key)
+        fields[key] = value if isinstance(value, str) else None
+    for key, kind in (('assignment', int), ('attempt', float)):
+        try:
+            fields[key] = kind(data[key])
+        except (KeyError, TypeError, ValueError):
+            fields[key] = None
+    return fields
+
+
+def upgrade():
+    # activity and data_point used to be made by db_init.py's create_all,
+    # so databases upgraded from here on may not have them yet
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'activity' not in tables:
+        op.create_table('activity',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=40), nullable=True),
+        sa.Column('open_until', sa.DateTime(), nullable=True),
+        sa.Column('owner', sa.Integer(), nullable=True),
+        sa.Column('password', sa.String(length=40), nullable=True),
+        sa.Column('template', sa.String(length=60), nullable=False),
+        sa.ForeignKeyConstraint(['owner'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'data_point' not in tables:
+        op.create_table('data_point',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('data', sa.JSON(), nullable=True),
+        sa.Column('activity_id', sa.Integer(), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['activity_id'], ['activity.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+    op.add_column('data_point', sa.Column('users', sa.String(length=64), nullable=True))
+    op.add_column('data_point', sa.Column('measurement', sa.String(length=64), nullable=True))
+    op.add_column('data_point', sa.Column('assignment', sa.Integer(), nullable=True))
+    op.add_column('data_point', sa.Column('attempt', sa.Float(), nullable=True))
+
+    # backfill in pages so big tables don't have to fit in memory
+    data_point = sa.table('data_point',
+        sa.column('id', sa.Integer()),
+        sa.column('data', sa.JSON()),
+        sa.column('users', sa.String()),
+        sa.column('measurement', sa.String()),
+        sa.column('assignment', sa.Integer()),
+        sa.column('attempt', sa.Float()))
+    bind = op.get_bind()
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select([data_point.c.id, data_point.c.data])
+            .where(data_point.c.id > last_id)
+            .order_by(data_point.c.id)
+            .limit(5000)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for id, data in rows:
+            fields = indexed_fields(data or {})
+            fields['point_id'] = id
+            updates.append(fields)
+        bind.execute(
+            data_point.update()
+            .where(data_point.c.id == sa.bindparam('point_id'))
+            .values(users=sa.bindparam('users'),
+                    measurement=sa.bindparam('measurement'),
+                    assignment=sa.bindparam('assignment'),
+                    attempt=sa.bindparam('attempt')),
+            updates)
+        last_id = rows[-1][0]
+
+    op.create_index('ix_data_point_activity_measurement_users', 'data_point',
+                    ['activity_id', 'measurement', 'users'], unique=False)
+    op.create_index('ix_data_point_activity_users_assignment', 'data_point',
+                    ['activity_id', 'users', 'assignment'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_data_point_activity_users_assignment', table_name='data_point')
+    op.drop_index('ix_data_point_activity_measurement_users', table_name='data_point')
+    with op.batch_alter_table('data_point') as batch_op:
+        batch_op.drop_column('attempt')
+        batch_op.drop_column('assignment')
+        batch_op.drop_column('measurement')
+        batch_op.drop_column('users')
@@ -0,0 +1,93 @@
+"""score aggregates
+
+Revision ID: 8c41d7e2a9f3
+Revises: 5b2e8f1c9d47
+Create Date: 2026-10-17 18:41:52.730415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41d7e2a9f3'
+down_revision = '5b2e8f1c9d47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('score_aggregate',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('activity_id', sa.Integer(), nullable=True),
+    sa.Column('name', sa.String(length=64), nullable=True),
+    sa.Column('metric', sa.String(length=64), nullable=True),
+    sa.Column('count', sa.Integer(), nullable=True),
+    sa.Column('total', sa.Float(), nullable=True),
+    sa.Column('minimum', sa.Float(), nullable=True),
+    sa.Column('maximum', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['activity_id'], ['activity.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('activity_id', 'name', 'metric')
+    )
+    op.create_index(op.f('ix_score_aggregate_activity_id'), 'score_aggregate', ['activity_id'], unique=False)
+
+    # build the aggregates for the points already stored, a page at a time
+    data_point = sa.table('data_point',
+        sa.column('id', sa.Integer()),
+        sa.column('activity_id', sa.Integer()),
+        sa.column('data', sa.JSON()))
+    bind = op.get_bind()
+    totals = {}
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select([data_point.c.id, data_point.c.activity_id, data_point.c.data])
+            .where(data_point.c.id > last_id)
+            .order_by(data_point.c.id)
+            .limit(5000)).fetchall()
+        if not rows:
+            break
+        for id, activity_id, data in rows:
+            averages = (data or {}).get('averages')
+            # a dict, or a list of [metric value] pairs as NetLogo sends it
+            if isinstance(averages, list) and \
+                    all(isinstance(pair, list) and len(pair) == 2 for pair in averages):
+                try:
+                    averages = dict(averages)
+                except TypeError:
+                    continue
+            if not isinstance(averages, dict):
+                continue
+            name = str(data.get('name', data.get('users')))
+            for metric, value in averages.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                value = float(value)
+                key = (activity_id, name, metric)
+                if key not in totals:
+                    totals[key] = [0, 0.0, value, value]
+                t = totals[key]
+                t[0] += 1
+                t[1] += value
+                t[2] = min(t[2], value)
+                t[3] = max(t[3], value)
+        last_id = rows[-1][0]
+    if totals:
+        score_aggregate = sa.table('score_aggregate',
+            sa.column('activity_id', sa.Integer()),
+            sa.column('name', sa.String()),
+            sa.column('metric', sa.String()),
+            sa.column('count', sa.Integer()),
+            sa.column('total', sa.Float()),
+            sa.column('minimum', sa.Float()),
+            sa.column('maximum', sa.Float()))
+        op.bulk_insert(score_aggregate, [
+            {'activity_id' : activity_id, 'name' : name, 'metric' : metric,
+             'count' : t[0], 'total' : t[1], 'minimum' : t[2], 'maximum' : t[3]}
+            for (activity_id, name, metric), t in totals.items()])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_score_aggregate_activity_id'), table_name='score_aggregate')
+    op.drop_table('score_aggregate')
@@ -0,0 +1,33 @@
+"""responses
+
+Revision ID: a7c2e9d41f06
+Revises: d3f9a1c47b20
+Create Date: 2026-10-17 21:14:37.402518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c2e9d41f06'
+down_revision = 'd3f9a1c47b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('response',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('activity_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('data', sa.JSON(), nullable=True),
+    sa.ForeignKeyConstraint(['activity_id'], ['activity.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_response_activity_id'), 'response', ['activity_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_response_activity_id'), table_name='response')
+    op.drop_table('response')
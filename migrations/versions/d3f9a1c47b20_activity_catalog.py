@@ -0,0 +1,74 @@
+"""activity catalog
+
+Revision ID: d3f9a1c47b20
+Revises: 8c41d7e2a9f3
+Create Date: 2026-10-17 19:52:08.114263
+
+"""
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f9a1c47b20'
+down_revision = '8c41d7e2a9f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalog_entry',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('activity_id', sa.Integer(), nullable=True),
+    sa.Column('kind', sa.String(length=16), nullable=True),
+    sa.Column('value', sa.String(length=255), nullable=True),
+    sa.ForeignKeyConstraint(['activity_id'], ['activity.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('activity_id', 'kind', 'value')
+    )
+    op.create_index(op.f('ix_catalog_entry_activity_id'), 'catalog_entry', ['activity_id'], unique=False)
+
+    # the catalog of the points already stored, read a page at a time; the
+    # same entries as app.catalog.entries, which we don't import here
+    data_point = sa.table('data_point',
+        sa.column('id', sa.Integer()),
+        sa.column('activity_id', sa.Integer()),
+        sa.column('data', sa.JSON()))
+    bind = op.get_bind()
+    seen = set()
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select([data_point.c.id, data_point.c.activity_id, data_point.c.data])
+            .where(data_point.c.id > last_id)
+            .order_by(data_point.c.id)
+            .limit(5000)).fetchall()
+        if not rows:
+            break
+        for id, activity_id, data in rows:
+            if not isinstance(data, dict):
+                continue
+            values = [('key', key) for key in data]
+            for kind, field in (('student', 'users'), ('measurement', 'measurement'),
+                                ('assignment', 'assignment')):
+                if field in data:
+                    values.append((kind, data[field]))
+            for kind, value in values:
+                value = json.dumps(value, sort_keys=True)
+                if len(value) <= 255:
+                    seen.add((activity_id, kind, value))
+        last_id = rows[-1][0]
+    if seen:
+        catalog_entry = sa.table('catalog_entry',
+            sa.column('activity_id', sa.Integer()),
+            sa.column('kind', sa.String()),
+            sa.column('value', sa.String()))
+        op.bulk_insert(catalog_entry, [
+            {'activity_id' : activity_id, 'kind' : kind, 'value' : value}
+            for activity_id, kind, value in sorted(seen, key=lambda e: (e[0] or 0, e[1], e[2]))])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_catalog_entry_activity_id'), table_name='catalog_entry')
+    op.drop_table('catalog_entry')
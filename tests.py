@@ -1,8 +1,34 @@
 #!/usr/bin/env python
 from datetime import datetime, timedelta
 import unittest
-from app import app, db
-from app.models import User, Post
+import ast
+import csv
+import gzip
+import importlib
+import io
+import json
+import logging
+import math
+import queue
+import os
+import random
+import socketserver
+import struct
+import tempfile
+import threading
+from unittest import mock
+import numpy as np
+from app import app, catalog, columns, db, export, heatmap, ingest, landscape, last_seen, logolist, replay, \
+    responses
+from app.models import User, Post, Activity, DataPoint, ScoreAggregate, CatalogEntry, Response
+from app.writebehind import WriteBehindQueue
+from app.cache import response_cache
+from app.lru import LRU
+from app.email import MailQueue
+from flask_mail import Message
+from flask_migrate import upgrade
+from sqlalchemy import create_engine
+import config
 
 
 class UserModelCase(unittest.TestCase):
@@ -88,5 +114,1227 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class IngestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['TESTING'] = True
+        db.create_all()
+        Activity.invalidate_cache()
+        catalog.invalidate_cache()
+        self.activity = Activity(name='test', password='pw', template='activity.html')
+        db.session.add(self.activity)
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_add_data_batch(self):
+        rv = self.client.post('/add_data_batch', data={
+            'users': 'anna', 'activity': str(self.activity.id),
+            'keys': '["x", "y"]', 'rows': '[[1, 2], [3], [5, 6]]'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data),
+                         {'inserted': 2,
+                          'errors': [[1, 'Length of keys and values did not match']]})
+        points = DataPoint.query.order_by(DataPoint.id).all()
+        self.assertEqual([p.data for p in points],
+                         [{'x': 1, 'y': 2, 'users': 'anna'},
+                          {'x': 5, 'y': 6, 'users': 'anna'}])
+
+    def test_open_activities(self):
+        rv = self.client.get('/open_activities')
+        self.assertEqual(json.loads(rv.data),
+                         '[[{} "test"]]'.format(self.activity.id))
+
+    def test_activity_cache(self):
+        self.assertEqual(Activity.cached(self.activity.id).password, 'pw')
+        self.assertIsNone(Activity.cached(self.activity.id + 1))
+        self.assertIsNone(Activity.cached('nope'))
+        self.activity.password = 'new'
+        other = Activity(name='other', password='pw2', template='activity.html')
+        db.session.add(other)
+        db.session.commit()
+        self.assertEqual(Activity.cached(self.activity.id).password, 'new')
+        self.assertEqual([a.name for a in Activity.all_cached()], ['test', 'other'])
+
+    def test_check_password(self):
+        rv = self.client.get('/check_password', query_string={
+            'activity': self.activity.id, 'password': 'pw'})
+        self.assertTrue(json.loads(rv.data))
+        rv = self.client.get('/check_password', query_string={
+            'activity': self.activity.id + 1, 'password': 'pw'})
+        self.assertFalse(json.loads(rv.data))
+
+    def test_ingest_token(self):
+        token = json.loads(self.client.get('/check_password', query_string={
+            'activity': self.activity.id, 'password': 'pw', 'users': 'anna', 'token': 1}).data)
+        wrong = json.loads(self.client.get('/check_password', query_string={
+            'activity': self.activity.id, 'password': 'no', 'users': 'anna', 'token': 1}).data)
+        self.assertFalse(wrong)
+        rv = self.client.get('/add_data', query_string={
+            'token': token, 'keys': '["x"]', 'values': '[1]'})
+        self.assertEqual(rv.status_code, 200)
+        rv = self.client.post('/add_data_batch', data={
+            'token': token, 'activity': str(self.activity.id), 'keys': '["x"]', 'rows': '[[2]]'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual([(p.activity_id, p.data) for p in DataPoint.query.order_by(DataPoint.id)],
+                         [(self.activity.id, {'x': 1, 'users': 'anna'}),
+                          (self.activity.id, {'x': 2, 'users': 'anna'})])
+        for args, status in [({'token': token + 'x'}, 401),
+                             ({'token': token, 'users': 'bo'}, 403),
+                             ({'token': token, 'activity': self.activity.id + 1}, 403)]:
+            args.update({'keys': '["x"]', 'values': '[3]'})
+            self.assertEqual(self.client.get('/add_data', query_string=args).status_code, status)
+        app.config['INGEST_TOKEN_TTL'] = -1
+        try:
+            rv = self.client.get('/add_data', query_string={
+                'token': token, 'keys': '["x"]', 'values': '[3]'})
+        finally:
+            app.config['INGEST_TOKEN_TTL'] = 8 * 3600
+        self.assertEqual(rv.status_code, 401)
+        self.assertEqual(DataPoint.query.count(), 2)
+
+    def test_score_aggregates(self):
+        act = self.activity.id
+        ingest.insert_data_points(act, [
+            {'name': 'anna', 'averages': {'Population': 10, 'Pollution': 1.5}},
+            {'name': 'bo', 'averages': {'Population': 4}},
+            {'x': 1}])
+        ingest.insert_data_points(act, [
+            {'name': 'anna', 'averages': {'Population': 30, 'Pollution': 0.5}}])
+        aggs = {(a.name, a.metric): a for a in ScoreAggregate.query.all()}
+        self.assertEqual(len(aggs), 3)
+        population = aggs[('anna', 'Population')]
+        self.assertEqual((population.count, population.total, population.minimum,
+                          population.maximum, population.mean), (2, 40, 10, 30, 20))
+        self.assertEqual(aggs[('anna', 'Pollution')].mean, 1.0)
+        rv = self.client.get('/highscore/{}'.format(act))
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'<td>20.0</td>', rv.data)
+
+    def test_score_aggregates_from_pairs_and_orm(self):
+        act = self.activity.id
+        # NetLogo sends averages as a list of [metric value] pairs
+        ingest.insert_data_points(act, [
+            {'name': 'anna', 'averages': [['Population', 10], ['Cows', 2]]}])
+        db.session.add(DataPoint(activity=self.activity, data={
+            'name': 'anna', 'averages': [['Population', 20]]}))
+        db.session.add(DataPoint(activity=self.activity, data={
+            'name': 'bo', 'averages': {'Population': 5}}))
+        db.session.add(DataPoint(activity=self.activity, data={
+            'name': 'carl', 'averages': [['Population']]}))
+        db.session.commit()
+        aggs = {(a.name, a.metric): (a.count, a.total) for a in ScoreAggregate.query.all()}
+        self.assertEqual(aggs, {('anna', 'Population'): (2, 30), ('anna', 'Cows'): (1, 2),
+                                ('bo', 'Population'): (1, 5)})
+
+    def test_score_aggregate_insert_race(self):
+        # another writer inserted anna's row after we looked for it
+        ingest.insert_data_points(self.activity.id, [
+            {'name': 'anna', 'averages': {'Population': 10}}])
+        row = {'activity_id': self.activity.id, 'metric': 'Population', 'count': 1,
+               'total': 4.0, 'minimum': 4.0, 'maximum': 4.0}
+        updates = ingest._insert_aggregates(db.session.connection(), ScoreAggregate.__table__,
+                                            [dict(row, name='anna'), dict(row, name='bo')])
+        db.session.commit()
+        self.assertEqual([u['b_name'] for u in updates], ['anna'])
+        self.assertEqual(sorted((a.name, a.total) for a in ScoreAggregate.query),
+                         [('anna', 10), ('bo', 4)])
+
+    def test_indexed_fields(self):
+        datas = [{'users': 'anna', 'measurement': 'score', 'assignment': '2', 'attempt': '1.5'},
+                 {'users': ['anna', 'bo'], 'measurement': 3, 'assignment': 'x', 'attempt': None},
+                 {'assignment': 2.0, 'attempt': 'nan?'},
+                 {}]
+        expected = [('anna', 'score', 2, 1.5), (None, None, None, None),
+                    (None, None, 2, None), (None, None, None, None)]
+        ingest.insert_data_points(self.activity.id, datas)
+        for data in datas:
+            db.session.add(DataPoint(activity=self.activity, data=data))
+        db.session.commit()
+        points = DataPoint.query.order_by(DataPoint.id).all()
+        self.assertEqual([(p.users, p.measurement, p.assignment, p.attempt) for p in points],
+                         expected + expected)
+
+    def test_add_data_batch_unknown_activity(self):
+        rv = self.client.post('/add_data_batch', data={
+            'users': 'anna', 'activity': '99', 'keys': '["x"]', 'rows': '[[1]]'})
+        self.assertEqual(rv.status_code, 400)
+        rv = self.client.post('/add_data_batch', data={
+            'activity': str(self.activity.id), 'keys': '["x"]', 'rows': '[[1]]'})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(DataPoint.query.count(), 0)
+
+
+class MigrationCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + self.path
+        # alembic's env.py sets up logging from alembic.ini
+        self.loggers = {name: logger.disabled for name, logger in
+                        logging.root.manager.loggerDict.items() if isinstance(logger, logging.Logger)}
+        self.root = (logging.root.level, list(logging.root.handlers))
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine().dispose()
+        os.remove(self.path)
+        for name, disabled in self.loggers.items():
+            logging.getLogger(name).disabled = disabled
+        logging.root.setLevel(self.root[0])
+        logging.root.handlers[:] = self.root[1]
+
+    def test_backfill_indexed_fields(self):
+        with app.app_context():
+            upgrade(revision='ae346256b650')
+            # activity and data_point as db_init.py made them before
+            engine = db.get_engine()
+            engine.execute('CREATE TABLE activity (id INTEGER PRIMARY KEY, name VARCHAR(40), '
+                           'open_until DATETIME, owner INTEGER, password VARCHAR(40), '
+                           'template VARCHAR(60) NOT NULL)')
+            engine.execute('CREATE TABLE data_point (id INTEGER PRIMARY KEY, data JSON, '
+                           'activity_id INTEGER, timestamp DATETIME)')
+            engine.execute("INSERT INTO activity (id, name, template) VALUES (1, 'a', 'activity.html')")
+            # more than one page of 5000
+            datas = [{'users': 'anna', 'measurement': 'score', 'assignment': n % 3, 'attempt': n}
+                     for n in range(5003)] + [{'users': 1, 'assignment': 'x'}]
+            engine.execute('INSERT INTO data_point (data, activity_id) VALUES (?, 1)',
+                           [(json.dumps(data),) for data in datas])
+            upgrade(revision='5b2e8f1c9d47')
+            rows = engine.execute('SELECT users, measurement, assignment, attempt '
+                                  'FROM data_point ORDER BY id').fetchall()
+        self.assertEqual(len(rows), 5004)
+        self.assertEqual(tuple(rows[0]), ('anna', 'score', 0, 0.0))
+        self.assertEqual(tuple(rows[5002]), ('anna', 'score', 5002 % 3, 5002.0))
+        self.assertEqual(tuple(rows[5003]), (None, None, None, None))
+
+
+class DatabaseProfileCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.pragmas = app.config['SQLITE_PRAGMAS']
+
+    def tearDown(self):
+        app.config['SQLITE_PRAGMAS'] = self.pragmas
+        self.dir.cleanup()
+
+    def test_wal(self):
+        with mock.patch.dict(os.environ, {'DATABASE_PROFILE': 'wal', 'SQLITE_BUSY_TIMEOUT': '2500'}):
+            profile = importlib.reload(config).Config
+        importlib.reload(config)
+        app.config['SQLITE_PRAGMAS'] = profile.SQLITE_PRAGMAS
+        engine = create_engine('sqlite:///' + os.path.join(self.dir.name, 'wal.db'),
+                               **profile.SQLALCHEMY_ENGINE_OPTIONS)
+        try:
+            with engine.connect() as connection:
+                pragmas = [connection.execute('PRAGMA ' + name).scalar()
+                           for name in ('journal_mode', 'synchronous', 'busy_timeout')]
+        finally:
+            engine.dispose()
+        self.assertEqual(pragmas, ['wal', 1, 2500])
+
+
+class WriteBehindCase(unittest.TestCase):
+    def test_flushes_everything_on_close(self):
+        written = []
+        q = WriteBehindQueue(written.extend, maxsize=100, batch_size=7,
+                             interval=0.01)
+        for n in range(50):
+            q.put(n)
+        q.close()
+        self.assertEqual(written, list(range(50)))
+        self.assertEqual(q.stats()['items_written'], 50)
+        self.assertEqual(q.stats()['queue_depth'], 0)
+
+    def test_retries_failed_flushes(self):
+        written = []
+        calls = []
+
+        def flaky(batch):
+            calls.append(list(batch))
+            if len(calls) == 1:
+                raise RuntimeError('database is locked')
+            written.extend(batch)
+
+        q = WriteBehindQueue(flaky, batch_size=10, interval=0.01, retry_delay=0.01)
+        for n in range(5):
+            q.put(n)
+        q.close()
+        self.assertEqual(written, list(range(5)))
+        self.assertEqual((q.stats()['retried'], q.stats()['items_failed']), (1, 0))
+        # nothing writes after close
+        self.assertRaises(queue.Full, q.put, 5)
+
+    def test_gives_up_after_retries(self):
+        failed = []
+
+        def broken(batch):
+            raise RuntimeError('disk full')
+
+        q = WriteBehindQueue(broken, batch_size=10, interval=0.01, retries=2,
+                             retry_delay=0.01, failed=failed.extend)
+        q.put(1)
+        q.put(2)
+        q.close()
+        self.assertEqual(failed, [1, 2])
+        self.assertEqual((q.stats()['retried'], q.stats()['items_failed']), (2, 2))
+
+    def test_rejects_when_full(self):
+        release = threading.Event()
+        taken = threading.Event()
+
+        def slow_flush(batch):
+            taken.set()
+            release.wait()
+
+        q = WriteBehindQueue(slow_flush, maxsize=2, batch_size=1, interval=0)
+        q.put(0)
+        taken.wait()
+        q.put(1)
+        q.put(2)
+        self.assertRaises(queue.Full, q.put, 3)
+        self.assertEqual(q.stats()['rejected'], 1)
+
+        app.config['INGEST_WRITE_BEHIND'] = True
+        saved = ingest.write_behind_queue.replace(q)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.create_all()
+        try:
+            act = Activity(name='test', password='pw', template='activity.html')
+            db.session.add(act)
+            db.session.commit()
+            rv = app.test_client().get('/add_data', query_string={
+                'users': 'anna', 'activity': act.id,
+                'keys': '["x"]', 'values': '[1]'})
+            self.assertEqual(rv.status_code, 503)
+        finally:
+            app.config['INGEST_WRITE_BEHIND'] = False
+            ingest.write_behind_queue.replace(saved)
+            release.set()
+            q.close()
+            db.session.remove()
+            db.drop_all()
+
+
+class ResponsesCase(unittest.TestCase):
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.create_all()
+        Activity.invalidate_cache()
+        activity = Activity(name='test', password='pw', template='activity.html')
+        db.session.add(activity)
+        db.session.commit()
+        self.act_id = activity.id
+        self.saved = responses.response_writer.replace(WriteBehindQueue(
+            responses._flush_responses, batch_size=4, interval=0.01, name='test-response-writer'))
+        app.config['LOGIN_DISABLED'] = True
+        app.config['RESPONSES_PAGE_SIZE'] = 3
+
+    def tearDown(self):
+        responses.response_writer.replace(self.saved).close()
+        app.config['LOGIN_DISABLED'] = False
+        app.config['RESPONSES_PAGE_SIZE'] = 1000
+        db.session.remove()
+        db.drop_all()
+
+    def test_submit_and_page(self):
+        client = app.test_client()
+        sent = [{'response': str(n), 'users': 'anna', 'activity': str(self.act_id)}
+                for n in range(10)]
+        for args in sent[:5] + [{'response': 'elsewhere', 'activity': '999'}] + sent[5:]:
+            self.assertEqual(client.get('/submit_response', query_string=args).status_code, 200)
+        self.assertEqual(client.get('/submit_response', query_string={'users': 'anna'}).status_code, 400)
+        responses.response_writer().close()
+        self.assertEqual(Response.query.count(), 11)
+        self.assertIsNone(Response.query.filter(Response.data['response'].as_string() == 'elsewhere')
+                          .one().activity_id)
+
+        received = []
+        since = None
+        while True:
+            page = json.loads(client.get('/responses/{}'.format(self.act_id),
+                                         query_string={} if since is None else {'since': since}).data)
+            if not page['data']:
+                break
+            self.assertLessEqual(len(page['data']), 3)
+            received.extend(page['data'])
+            since = page['cursor']
+        self.assertEqual([r['data'] for r in received], sent)
+        self.assertEqual(page['cursor'], received[-1]['id'])
+        self.assertEqual(client.get('/responses/999').status_code, 404)
+
+    def test_failed_flushes(self):
+        calls = []
+        flush = responses._flush_responses
+
+        def locked_once(rows):
+            calls.append(len(rows))
+            if len(calls) == 1:
+                raise RuntimeError('database is locked')
+            flush(rows)
+        responses.response_writer.replace(
+            WriteBehindQueue(locked_once, interval=0.01, retry_delay=0.01)).close()
+        client = app.test_client()
+        client.get('/submit_response', query_string={'response': 'a', 'activity': self.act_id})
+        responses.response_writer().close()
+        self.assertEqual([r.data['response'] for r in Response.query], ['a'])
+
+        # still failing after the retries: kept in a file to import later
+        path = os.path.join(tempfile.mkdtemp(), 'failed.txt')
+        app.config['RESPONSES_FAILED_PATH'] = path
+
+        def broken(rows):
+            raise RuntimeError('database is locked')
+        responses.response_writer.replace(WriteBehindQueue(
+            broken, interval=0.01, retries=1, retry_delay=0.01,
+            failed=responses._save_failed_responses)).close()
+        try:
+            for answer in ('b', 'c'):
+                client.get('/submit_response', query_string={'response': answer,
+                                                             'activity': self.act_id})
+            responses.response_writer().close()
+        finally:
+            app.config['RESPONSES_FAILED_PATH'] = 'responses_failed.txt'
+        self.assertEqual(Response.query.count(), 1)
+        result = app.test_cli_runner().invoke(args=['import-responses', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        os.remove(path)
+        self.assertEqual([(r.activity_id, r.data['response']) for r in Response.query.order_by(Response.id)],
+                         [(self.act_id, 'a'), (self.act_id, 'b'), (self.act_id, 'c')])
+
+    def test_busy(self):
+        release = threading.Event()
+        responses.response_writer.replace(WriteBehindQueue(
+            lambda batch: release.wait(), maxsize=1, batch_size=1, interval=0)).close()
+        try:
+            statuses = [app.test_client().get('/submit_response', query_string={
+                'response': 'yes'}).status_code for _ in range(5)]
+        finally:
+            release.set()
+        self.assertIn(503, statuses)
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(6 if depth < 3 else 5)
+    if kind == 0:
+        return rng.randint(-10 ** 6, 10 ** 6)
+    if kind == 1:
+        return rng.uniform(-1e6, 1e6) * rng.choice([1, 1e-9, 1e12])
+    if kind == 2:
+        return ''.join(rng.choice('ab ,[]()\'"\\\n\tøæ') for _ in range(rng.randrange(8)))
+    if kind == 3:
+        return rng.choice([True, False])
+    if kind == 4:
+        return None
+    return [random_value(rng, depth + 1) for _ in range(rng.randrange(6))]
+
+
+def python_literal(value, separator):
+    if isinstance(value, list):
+        return '[' + separator.join(python_literal(v, separator) for v in value) + ']'
+    return repr(value)
+
+
+class LogoListParseCase(unittest.TestCase):
+    def test_matches_literal_eval(self):
+        rng = random.Random(42)
+        for _ in range(2000):
+            value = [random_value(rng) for _ in range(rng.randrange(6))]
+            text = python_literal(value, rng.choice([', ', ',', ' ,', ',\n']))
+            self.assertEqual(logolist.loads(text), ast.literal_eval(text), text)
+
+    def test_flat_numbers(self):
+        for text in ['[]', '[1]', '[1, 2.5, -3, 1e3, .5, -1.5E-2]', ' [ 1 ,2 ] ']:
+            self.assertEqual(logolist.loads(text), ast.literal_eval(text), text)
+
+    def test_netlogo_syntax(self):
+        self.assertEqual(logolist.loads('[1 2.5 "a b" true false [3 ["x"]] []]'),
+                         [1, 2.5, 'a b', True, False, [3, ['x']], []])
+        self.assertEqual(logolist.loads('["\\"quoted\\"" "back\\\\slash"]'),
+                         ['"quoted"', 'back\\slash'])
+
+    def test_tuples(self):
+        for text in ['(1, 2)', '(1,)', '(1)', '()', '[(1, [2]), ("a",)]']:
+            self.assertEqual(logolist.loads(text), ast.literal_eval(text), text)
+
+    def test_malformed(self):
+        for text in ['', '[1 2', '[1 2]]', '[1)', '[foo]', '[1] [2]', '"abc']:
+            self.assertRaises(ValueError, logolist.loads, text)
+
+
+class LogoListDumpCase(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(logolist.dumps([[1, 'High Score'], [2, 'b']]),
+                         '[[1 "High Score"] [2 "b"]]')
+        self.assertEqual(logolist.dumps([True, False, None, 2.5, (1,), []]),
+                         '[true false nobody 2.5 [1] []]')
+        self.assertEqual(logolist.dumps({'a': [1]}), '[["a" [1]]]')
+
+    def test_escapes_strings(self):
+        text = 'say "hi", (ok)\\\n'
+        self.assertEqual(logolist.dumps(text), '"say \\"hi\\", (ok)\\\\\\n"')
+        rng = random.Random(7)
+        for _ in range(500):
+            value = [random_value(rng) for _ in range(rng.randrange(6))]
+            self.assertEqual(logolist.loads(logolist.dumps(value)), value)
+
+    def test_rejects_unknown(self):
+        self.assertRaises(TypeError, logolist.dumps, [object()])
+        self.assertRaises(ValueError, logolist.dumps, [float('nan')])
+
+
+def sorted_cells(cells):
+    return sorted(cells, key=lambda c: (c['x'], c['y']))
+
+
+class HeatmapGridCase(unittest.TestCase):
+    def test_add(self):
+        grid = heatmap.HeatmapGrid(2)
+        grid.add(np.array([1, 2, 3]), np.array([0.5, 1.5, -0.5]),
+                 np.array([0.0, 1.9, 3.0]), np.array([1.0, 3.0, 5.0]))
+        grid.add(np.array([4, 5]), np.array([3.0, 1.0]),
+                 np.array([0.0, 1.0]), np.array([7.0, 2.0]))
+        self.assertEqual(len(grid), 3)
+        self.assertEqual(grid.cursor, 5)
+        data, max_v = grid.cells()
+        self.assertEqual(sorted_cells(data), [
+            {'x': -2, 'y': 2, 'v': 5.0},
+            {'x': 0, 'y': 0, 'v': 2.0},
+            {'x': 2, 'y': 0, 'v': 7.0}])
+        self.assertEqual(max_v, 7.0)
+        data, max_v = grid.cells('count', since=3)
+        self.assertEqual(sorted_cells(data), [
+            {'x': 0, 'y': 0, 'v': 3.0}, {'x': 2, 'y': 0, 'v': 1.0}])
+        self.assertEqual(max_v, 3.0)
+        data, _ = grid.cells('max', since=5)
+        self.assertEqual(data, [])
+
+
+class LRUCase(unittest.TestCase):
+    def test_drops_least_recently_used(self):
+        app.config['LRU_TEST_SIZE'] = 2
+        try:
+            cache = LRU('LRU_TEST_SIZE')
+            cache.put('a', 1)
+            self.assertEqual(cache.setdefault('b', lambda: 2), 2)
+            self.assertEqual(cache.get('a'), 1)
+            self.assertEqual(cache.setdefault('c', lambda: 3), 3)
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(cache.setdefault('a', lambda: 4), 1)
+            app.config['LRU_TEST_SIZE'] = 1
+            cache.put('d', 5)
+            self.assertEqual((len(cache), cache.get('d')), (1, 5))
+        finally:
+            del app.config['LRU_TEST_SIZE']
+
+
+class LandscapeCase(unittest.TestCase):
+
+    def test_curve_and_surface(self):
+        curve = landscape.evaluate('sin(x) + 2^3', (0, np.pi, -1, 1), 2)
+        self.assertEqual(curve['x'], [0, np.pi / 2, np.pi])
+        np.testing.assert_allclose(curve['y'], [8, 9, 8])
+        surface = landscape.evaluate('x * y', (0, 2, 0, 1), 2)
+        self.assertEqual(surface['y'], [0, 0.5, 1])
+        self.assertEqual(surface['z'], [[0, 0, 0], [0, 0.5, 1], [0, 1, 2]])
+        flat = landscape.evaluate('3', (0, 1, 0, 1), 1)
+        self.assertEqual(flat['y'], [3, 3])
+        # no NaN or infinity in JSON
+        self.assertEqual(landscape.evaluate('log(x)', (-1, 1, 0, 1), 2)['y'], [None, None, 0])
+
+    def test_unsafe(self):
+        for text in ['__import__("os").system("true")', 'x.real', '[x]', 'lambda: 1',
+                     'open("f")', 'True', '"x"', 'x if x else y', 'sin(x, y, x, x, x)',
+                     'sin(x, x)', 'min(x, y, x)', 'sin(1, x)', 'max(x)', 'cos()',
+                     'x(1)', 'z', '-' * 2000 + 'x', 'x +', 42]:
+            with self.assertRaises(ValueError):
+                f, surface = landscape.compile_function(text)
+                f(np.zeros(3), np.zeros(3))
+        # floats overflow where Python ints would take forever
+        self.assertEqual(landscape.evaluate('9^9^9^9', (0, 1, 0, 1), 1)['y'], [None, None])
+
+
+class DashboardQueryCase(unittest.TestCase):
+    # the dashboard endpoints against the Python filtering they used to do
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.create_all()
+        Activity.invalidate_cache()
+        catalog.invalidate_cache()
+        heatmap.invalidate_cache()
+        replay.invalidate_cache()
+        landscape.invalidate_cache()
+        response_cache.clear()
+        self.activity = Activity(name='test', password='pw', template='activity.html')
+        other = Activity(name='other', password='pw', template='activity.html')
+        db.session.add_all([self.activity, other])
+        db.session.commit()
+        rng = random.Random(3)
+        for n in range(300):
+            data = {'x': rng.randrange(30), 'y': rng.uniform(0, 30),
+                    'v': rng.randrange(100),
+                    'measurement': rng.choice(['heat', 'food']),
+                    'users': rng.choice(['anna', 'bo', 'carl']),
+                    'assignment': rng.choice([1, 2.0, '2']),
+                    'attempt': rng.randrange(10)}
+            if rng.random() < 0.2:
+                data['extra'] = n
+            act = self.activity if rng.random() < 0.8 else other
+            db.session.add(DataPoint(data=data, activity=act))
+        db.session.commit()
+        self.act_id = self.activity.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def get(self, url, **args):
+        args['act_id'] = self.act_id
+        return json.loads(self.client.get(url, query_string=args).data)
+
+    def points(self):
+        return [p.data for p in
+                DataPoint.query.filter_by(activity_id=self.act_id).order_by(DataPoint.id)]
+
+    def test_measurement_and_heatmap(self):
+        for student in ['all', 'anna', 'nobody']:
+            points = [d for d in self.points()
+                      if d['measurement'] == 'heat' and
+                      (student == 'all' or student == d['users'])]
+            self.assertEqual(
+                self.get('/get_measurement_data', measurement='heat', student=student),
+                [{'x': d['x'], 'y': d['y']} for d in points])
+            data, max_v = self.get('/get_heatmap_data', measurement='heat', student=student)
+            expected = self.cells(points)
+            self.assertEqual(sorted_cells(data), expected)
+            self.assertEqual(max_v, max([0] + [c['v'] for c in expected]))
+            data, max_v = self.get('/get_heatmap_data', measurement='heat', student=student,
+                                   stat='max')
+            self.assertEqual(sorted_cells(data), self.cells(points, max))
+        self.assertEqual(self.client.get('/get_heatmap_data', query_string={
+            'act_id': self.act_id, 'measurement': 'heat', 'student': 'all',
+            'stat': 'median'}).status_code, 400)
+
+    def cells(self, points, stat=lambda vs: sum(vs) / len(vs)):
+        # the heatmap cells the slow way
+        binned = {}
+        for d in points:
+            binned.setdefault((math.floor(d['x']), math.floor(d['y'])), []).append(d['v'])
+        return [{'x': x, 'y': y, 'v': stat(vs)} for (x, y), vs in sorted(binned.items())]
+
+    def test_since_cursor(self):
+        first = self.get('/get_heatmap_data', measurement='heat', student='all', since=0)
+        full = self.get('/get_heatmap_data', measurement='heat', student='all')
+        self.assertEqual(sorted_cells(first['data']), sorted_cells(full[0]))
+        self.assertEqual(first['max_v'], full[1])
+        nothing = self.get('/get_heatmap_data', measurement='heat', student='all',
+                           since=first['cursor'])
+        self.assertEqual(nothing, {'data': [], 'max_v': full[1], 'cursor': first['cursor']})
+
+        all_points = self.get('/get_2d_data', since=0)
+        db.session.add(DataPoint(activity_id=self.act_id, data={
+            'x': 1, 'y': 2, 'v': 3, 'measurement': 'heat', 'users': 'anna'}))
+        db.session.commit()
+        delta = self.get('/get_heatmap_data', measurement='heat', student='all',
+                         since=first['cursor'])
+        # only the cell that changed, with the new point folded into its mean
+        points = [d for d in self.points() if d['measurement'] == 'heat']
+        self.assertEqual(delta['data'],
+                         [c for c in self.cells(points) if (c['x'], c['y']) == (1, 2)])
+        self.assertGreater(delta['cursor'], first['cursor'])
+        delta = self.get('/get_2d_data', since=all_points['cursor'])
+        self.assertEqual(delta['data'], [{'x': 1, 'y': 2}])
+        delta = self.get('/get_measurement_data', measurement='heat', student='bo',
+                         since=first['cursor'])
+        self.assertEqual(delta, {'data': [], 'cursor': first['cursor']})
+
+    def test_stream(self):
+        app.config['STREAM_HEARTBEAT'] = 0.05
+        rv = self.client.get('/stream/{}'.format(self.act_id), buffered=False,
+                             query_string={'measurement': 'heat', 'student': 'anna',
+                                           'kind': 'heatmap'})
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        events = iter(rv.response)
+        self.assertEqual(next(events), b'retry: 2000\n\n')
+        first = next(events).decode()
+        cursor, message = first.split('\n')[:2]
+        message = json.loads(message[len('data: '):])
+        self.assertEqual(cursor, 'id: {}'.format(message['cursor']))
+        anna = [d for d in self.points()
+                if d['measurement'] == 'heat' and d['users'] == 'anna']
+        self.assertEqual(sorted_cells(message['data']), self.cells(anna))
+        self.assertEqual(next(events), b': keepalive\n\n')
+
+        self.client.get('/add_data', query_string={
+            'users': 'anna', 'activity': self.act_id,
+            'keys': '["x" "y" "v" "measurement"]', 'values': '[1 2 500 "heat"]'})
+        pushed = json.loads(next(events).decode().split('\n')[1][len('data: '):])
+        anna.append({'x': 1, 'y': 2, 'v': 500})
+        cell = [c for c in self.cells(anna) if (c['x'], c['y']) == (1, 2)]
+        self.assertEqual(pushed['data'], cell)
+        self.assertEqual(pushed['max_v'], max(c['v'] for c in self.cells(anna)))
+        rv.close()
+
+        # a student without a measurement gets all of their points only
+        rv = self.client.get('/stream/{}'.format(self.act_id), buffered=False,
+                             query_string={'student': 'bo'})
+        events = iter(rv.response)
+        next(events)
+        message = json.loads(next(events).decode().split('\n')[1][len('data: '):])
+        self.assertEqual(message['data'], [{'x': d['x'], 'y': d['y']} for d in self.points()
+                                           if d['users'] == 'bo'])
+        rv.close()
+        app.config['STREAM_HEARTBEAT'] = 15
+
+    def test_replay(self):
+        points = [d for d in self.points()
+                  if d['users'] == 'bo' and int(d['assignment']) == 2]
+        expected = sorted([{'x': d['x'], 'y': d['y'], 'attempt': d['attempt']}
+                           for d in points], key=lambda d: d['attempt'])
+        data, labels, _ = self.get('/get_replay_data', students='bo', assignment=2)
+        self.assertEqual(data, expected)
+        self.assertEqual(len(labels), len(expected))
+        # the chart's selects are empty until the lists have loaded
+        for assignment in ['', 'x', None]:
+            rv = self.client.get('/get_replay_data', query_string={
+                'act_id': self.act_id, 'students': '', 'assignment': assignment})
+            self.assertEqual(rv.status_code, 400)
+
+    def test_replay_after(self):
+        data, labels, _ = self.get('/get_replay_data', students='bo', assignment=2)
+        # new points land in attempt order, not at the end
+        for attempt in (3, 12):
+            db.session.add(DataPoint(activity=self.activity, data={
+                'x': attempt, 'y': -1, 'users': 'bo', 'assignment': 2, 'attempt': attempt}))
+        db.session.commit()
+        full, full_labels, _ = self.get('/get_replay_data', students='bo', assignment=2)
+        self.assertEqual(len(full), len(data) + 2)
+        self.assertEqual([d['attempt'] for d in full], sorted(d['attempt'] for d in full))
+        self.assertEqual(full_labels, ['Attempt ' + str(n) for n in range(len(full))])
+        after, after_labels, _ = self.get('/get_replay_data', students='bo', assignment=2, after=4)
+        first = len([d for d in full if d['attempt'] <= 4])
+        self.assertEqual(after, full[first:])
+        self.assertEqual(after_labels, full_labels[first:])
+        self.assertEqual(self.get('/get_replay_data', students='bo', assignment=2, after=12), [[], [], None])
+
+    def test_replay_landscape(self):
+        self.assertIsNone(self.get('/get_replay_data', students='bo', assignment=2)[2])
+        db.session.add(DataPoint(activity=self.activity, data={
+            'function': 'x^2 / 10', 'users': 'bo', 'assignment': 2, 'xmin': -5, 'xmax': 5}))
+        db.session.commit()
+        evaluated = []
+        evaluate = landscape.evaluate
+        landscape.evaluate = lambda *args: evaluated.append(args) or evaluate(*args)
+        try:
+            for _ in range(3):
+                _, _, ground = self.get('/get_replay_data', students='bo', assignment=2)
+        finally:
+            landscape.evaluate = evaluate
+        self.assertEqual(len(evaluated), 1)
+        self.assertEqual(ground['function'], 'x^2 / 10')
+        self.assertEqual(ground['x'][0], -5)
+        self.assertEqual(len(ground['y']), app.config['LANDSCAPE_STEPS'] + 1)
+        self.assertAlmostEqual(ground['y'][0], 2.5)
+        self.assertEqual(self.get_columns('/get_replay_data', students='bo',
+                                          assignment=2)['landscape'], ground)
+
+    def test_keyed_and_2d(self):
+        self.assertEqual(
+            self.get('/get_keyed_data', xkey='extra', ykey='y'),
+            [{'x': d['extra'], 'y': d['y']} for d in self.points() if 'extra' in d])
+        self.assertEqual(
+            self.get('/get_2d_data'),
+            [{'x': d['x'], 'y': d['y']} for d in self.points()])
+
+    def get_columns(self, url, headers=None, **args):
+        args['act_id'] = self.act_id
+        if headers is None:
+            args['format'] = 'columns'
+        rv = self.client.get(url, query_string=args, headers=headers)
+        self.assertEqual(rv.mimetype, columns.MIMETYPE)
+        self.assertIn('Accept', rv.headers['Vary'])
+        size, = struct.unpack('<I', rv.data[:4])
+        header = json.loads(rv.data[4:4 + size])
+        offset = 4 + size
+        self.assertEqual(offset % 8, 0)
+        data = {}
+        for name in header['columns']:
+            data[name] = np.frombuffer(rv.data, '<f8', header['count'], offset).tolist()
+            offset += 8 * header['count']
+        self.assertEqual(offset, len(rv.data))
+        header['data'] = [dict(zip(data, values)) for values in zip(*data.values())]
+        return header
+
+    def test_columns(self):
+        for student in ['all', 'bo']:
+            args = {'measurement': 'heat', 'student': student}
+            self.assertEqual(self.get_columns('/get_measurement_data', **args)['data'],
+                             self.get('/get_measurement_data', **args))
+            binary = self.get_columns('/get_heatmap_data', **args)
+            data, max_v = self.get('/get_heatmap_data', **args)
+            self.assertEqual(sorted_cells(binary['data']), sorted_cells(data))
+            self.assertEqual(binary['max_v'], max_v)
+        since = self.get_columns('/get_measurement_data', measurement='heat',
+                                 student='all', since=0)
+        self.assertEqual(since['cursor'], self.get('/get_measurement_data', measurement='heat',
+                                                   student='all', since=0)['cursor'])
+        nothing = self.get_columns('/get_heatmap_data', measurement='heat',
+                                   student='all', since=since['cursor'])
+        self.assertEqual((nothing['count'], nothing['cursor']), (0, since['cursor']))
+
+        accept = {'Accept': columns.MIMETYPE}
+        data, labels, _ = self.get('/get_replay_data', students='bo', assignment=2)
+        self.assertEqual(self.get_columns('/get_replay_data', accept, students='bo',
+                                          assignment=2)['data'], data)
+        # browsers' usual Accept headers still get JSON
+        rv = self.client.get('/get_2d_data', query_string={'act_id': self.act_id},
+                             headers={'Accept': '*/*'})
+        self.assertEqual(rv.mimetype, 'application/json')
+        rv.close()
+
+    def test_response_cache(self):
+        url = '/get_measurement_keys_and_students'
+        args = {'act_id': self.act_id}
+        measurements, students = self.get(url)
+        self.assertEqual(measurements, ['food', 'heat'])
+        self.assertEqual(students, ['anna', 'bo', 'carl', 'all'])
+        rv = self.client.get(url, query_string=args)
+        self.assertEqual(response_cache.stats()['hits'], 1)
+        etag = rv.headers['ETag']
+        rv = self.client.get(url, query_string=args, headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+        # other query strings are cached separately
+        self.assertEqual(self.get(url, v='2'), [measurements, students])
+        self.assertEqual((response_cache.stats()['hits'], response_cache.stats()['misses']), (2, 2))
+
+        # storing points for the activity makes the cached responses stale
+        self.client.get('/add_data', query_string={
+            'users': 'dora', 'activity': self.act_id,
+            'keys': '["x" "y" "measurement"]', 'values': '[1 2 "wind"]'})
+        rv = self.client.get(url, query_string=args, headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data),
+                         [['food', 'heat', 'wind'], ['anna', 'bo', 'carl', 'dora', 'all']])
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        self.assertEqual(response_cache.stats(), {
+            'entries': 2, 'capacity': app.config['RESPONSE_CACHE_SIZE'],
+            'hits': 2, 'misses': 3})
+        app.config['RESPONSE_CACHE_SIZE'] = 1
+        self.get('/get_data_keys_and_students')
+        self.assertEqual(response_cache.stats()['entries'], 1)
+        app.config['RESPONSE_CACHE_SIZE'] = 512
+
+    def test_catalog(self):
+        # the selector endpoints against the scan they used to do
+        points = self.points()
+        keys = sorted({k for d in points for k in d})
+        students = sorted({d['users'] for d in points})
+        self.assertEqual(self.get('/get_data_keys'), keys)
+        self.assertEqual(self.get('/get_data_keys_and_students'),
+                         {'keys': keys, 'students': students})
+        self.assertEqual(self.get('/get_measurement_keys_and_students'),
+                         [['food', 'heat'], students + ['all']])
+        # the old sorted() choked on mixing 1 and '2'
+        self.assertEqual(self.get('/get_students_and_assignments'), [students, [1, 2.0, '2']])
+        self.assertEqual(CatalogEntry.query.filter_by(activity_id=self.act_id,
+                                                      kind='assignment').count(), 3)
+
+        # nothing from a rolled back insert
+        db.session.add(DataPoint(activity_id=self.act_id, data={'users': 'eve', 'z': 1}))
+        db.session.flush()
+        db.session.rollback()
+        ingest.insert_data_points(self.act_id, [{'users': 'dan', 'w': [1, 2]}])
+        response_cache.clear()
+        self.assertEqual(self.get('/get_data_keys'), sorted(keys + ['w']))
+        self.assertEqual(self.get('/get_students_and_assignments')[0],
+                         sorted(students + ['dan']))
+        catalog.invalidate_cache()
+        self.assertEqual(self.get('/get_data_keys'), sorted(keys + ['w']))
+        self.assertEqual(self.client.get('/get_data_keys',
+                                         query_string={'act_id': 12345}).status_code, 404)
+
+    def test_streamed(self):
+        # small pieces, so the joins between them get exercised
+        app.config['JSON_STREAM_CHUNK'] = 7
+        ids = [p.id for p in DataPoint.query.filter_by(activity_id=self.act_id)
+               .order_by(DataPoint.id)]
+        rv = self.client.get('/get_2d_data', query_string={'act_id': self.act_id,
+                                                            'since': ids[10]})
+        self.assertTrue(rv.is_streamed)
+        self.assertEqual(rv.mimetype, 'application/json')
+        self.assertEqual(json.loads(rv.data), {
+            'data': [{'x': d['x'], 'y': d['y']} for d in self.points()[11:]],
+            'cursor': ids[-1]})
+        rv.close()
+        data, labels, _ = self.get('/get_replay_data', students='anna', assignment=2)
+        self.assertEqual(labels, ['Attempt {}'.format(n) for n in range(len(data))])
+        self.assertEqual(self.get('/get_keyed_data', xkey='nothing', ykey='y'), [])
+        rv = self.client.get('/get_keyed_data', query_string={'act_id': self.act_id, 'xkey': 'x'})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.get('/get_measurement_data', measurement='heat', student='bo',
+                                  since=10 ** 6),
+                         {'data': [], 'cursor': 10 ** 6})
+        # points without x and y, like high score points, are left out
+        before = self.get('/get_measurement_data', measurement='heat', student='bo')
+        ingest.insert_data_points(self.act_id, [
+            {'name': 'bo', 'averages': {'Population': 3}},
+            {'users': 'bo', 'measurement': 'heat', 'x': 1}])
+        self.assertEqual(self.get('/get_2d_data'), [{'x': d['x'], 'y': d['y']}
+                                                    for d in self.points() if 'y' in d])
+        self.assertEqual(self.get('/get_measurement_data', measurement='heat', student='bo'),
+                         before)
+        app.config['JSON_STREAM_CHUNK'] = 1000
+
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.create_all()
+        Activity.invalidate_cache()
+        catalog.invalidate_cache()
+        activity = Activity(name='test', password='pw', template='activity.html')
+        db.session.add(activity)
+        db.session.commit()
+        self.act_id = activity.id
+        self.points = [{'x': n, 'y': n / 4, 'users': 'anna'} for n in range(7)]
+        self.points[2]['flag'] = True
+        self.points[3]['y'] = 'NaN'
+        self.points[4]['path'] = [1, [2, 3]]
+        ingest.insert_data_points(self.act_id, self.points)
+        app.config['EXPORT_CHUNK_SIZE'] = 3
+
+    def tearDown(self):
+        app.config['EXPORT_CHUNK_SIZE'] = 5000
+        app.config['LOGIN_DISABLED'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def read_csv(self, data):
+        return list(csv.reader(io.StringIO(gzip.decompress(data).decode())))
+
+    def test_columns(self):
+        cols, until = export.columns(self.act_id)
+        self.assertEqual(cols, [
+            ('flag', 'bool'), ('path', 'str'), ('users', 'str'), ('x', 'int'), ('y', 'str')])
+        self.assertEqual(until, DataPoint.query.order_by(DataPoint.id.desc()).first().id)
+
+    def test_points_stored_during_export(self):
+        # a point with a new key and a string x, stored between the passes
+        columns = export.columns
+
+        def store_one_more(act_id):
+            found = columns(act_id)
+            ingest.insert_data_points(self.act_id, [{'x': 'late', 'late': 1}])
+            return found
+        export.columns = store_one_more
+        try:
+            out = io.BytesIO()
+            export.export_activity(self.act_id, out, 'csv')
+        finally:
+            export.columns = columns
+        rows = self.read_csv(out.getvalue())
+        self.assertEqual(len(rows), 8)
+        self.assertNotIn('late', rows[0])
+
+    @unittest.skipUnless(export.pyarrow, 'needs pyarrow')
+    def test_arrow_and_parquet(self):
+        for format in ('parquet', 'arrow'):
+            out = io.BytesIO()
+            self.assertEqual(export.export_activity(self.act_id, out, format), 7)
+            out.seek(0)
+            if format == 'parquet':
+                table = export.pyarrow.parquet.read_table(out)
+            else:
+                table = export.pyarrow.ipc.open_file(out).read_all()
+            self.assertEqual(table.column_names,
+                             ['data_point_id', 'stored_at', 'flag', 'path', 'users', 'x', 'y'])
+            self.assertEqual(str(table.schema.field('x').type), 'int64')
+            self.assertEqual(str(table.schema.field('flag').type), 'bool')
+            self.assertEqual(str(table.schema.field('stored_at').type), 'timestamp[us]')
+            rows = table.to_pylist()
+            self.assertEqual([r['x'] for r in rows], list(range(7)))
+            self.assertEqual([r['flag'] for r in rows], [None, None, True] + [None] * 4)
+            self.assertEqual(rows[4]['path'], '[1, [2, 3]]')
+            self.assertEqual([r['y'] for r in rows[:4]], ['0.0', '0.25', '0.5', 'NaN'])
+
+    def test_csv(self):
+        out = io.BytesIO()
+        self.assertEqual(export.export_activity(self.act_id, out, 'csv'), 7)
+        rows = self.read_csv(out.getvalue())
+        self.assertEqual(rows[0], ['data_point_id', 'stored_at', 'flag', 'path', 'users', 'x', 'y'])
+        self.assertEqual(len(rows), 8)
+        self.assertEqual([r[5] for r in rows[1:]], [str(n) for n in range(7)])
+        self.assertEqual(rows[3][2], 'True')
+        self.assertEqual(rows[5][3], '[1, [2, 3]]')
+        self.assertEqual(rows[4][6], 'NaN')
+        self.assertEqual(rows[2][6], '0.25')
+        with self.assertRaises(ValueError):
+            export.export_activity(self.act_id, out, 'xlsx')
+
+    def test_command_and_route(self):
+        path = os.path.join(tempfile.mkdtemp(), 'out.csv.gz')
+        result = app.test_cli_runner().invoke(
+            args=['export', str(self.act_id), path, '--format', 'csv'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(path, 'rb') as f:
+            from_command = self.read_csv(f.read())
+        os.remove(path)
+
+        client = app.test_client()
+        self.assertEqual(client.get('/export/{}'.format(self.act_id)).status_code, 302)
+        app.config['LOGIN_DISABLED'] = True
+        rv = client.get('/export/{}'.format(self.act_id), query_string={'format': 'csv'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.is_streamed)
+        self.assertIn('activity_{}.csv.gz'.format(self.act_id), rv.headers['Content-Disposition'])
+        self.assertEqual(self.read_csv(rv.data), from_command)
+        rv.close()
+        self.assertEqual(client.get('/export/12345').status_code, 404)
+        self.assertEqual(client.get('/export/{}'.format(self.act_id),
+                                    query_string={'format': 'xlsx'}).status_code, 400)
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.create_all()
+        Activity.invalidate_cache()
+        catalog.invalidate_cache()
+        activity = Activity(name='test', password='pw', template='activity.html')
+        db.session.add(activity)
+        db.session.commit()
+        self.act_id = activity.id
+        ingest.insert_data_points(self.act_id, [{'x': n, 'y': n} for n in range(25)])
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['METRICS_SLOW_REQUEST_MS'] = None
+        db.session.remove()
+        db.drop_all()
+
+    def metrics(self):
+        rv = self.client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        values = {}
+        for line in rv.data.decode().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+        return values
+
+    def test_metrics(self):
+        before = self.metrics()
+        rv = self.client.get('/get_2d_data', query_string={'act_id': self.act_id})
+        self.assertEqual(len(json.loads(rv.data)), 25)
+        rv.close()
+        rv = self.client.get('/open_activities')
+        after = self.metrics()
+
+        def delta(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        self.assertEqual(delta('app_requests_total{endpoint="get_2d_data",method="GET",status="200"}'), 1)
+        self.assertEqual(delta('app_request_duration_seconds_count{endpoint="get_2d_data"}'), 1)
+        self.assertEqual(delta('app_request_duration_seconds_bucket{endpoint="get_2d_data",le="+Inf"}'), 1)
+        self.assertGreaterEqual(delta('app_db_queries_per_request_sum{endpoint="get_2d_data"}'), 1)
+        self.assertGreater(delta('app_db_query_seconds_total{endpoint="get_2d_data"}'), 0)
+        self.assertEqual(delta('app_db_rows_total{endpoint="get_2d_data"}'), 25)
+        # streamed, and counted as it goes out
+        self.assertEqual(delta('app_response_bytes_total{endpoint="get_2d_data"}'),
+                         len(json.dumps([{'x': n, 'y': n} for n in range(25)],
+                                        separators=(',', ':'))))
+        self.assertEqual(delta('app_response_bytes_total{endpoint="get_open_activities"}'),
+                         len(rv.data))
+        self.assertIn('app_ingest_queue_depth', after)
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics', environ_base={
+            'REMOTE_ADDR': '10.0.0.1'}).status_code, 404)
+        # behind a proxy every request is local
+        app.config['METRICS_TOKEN'] = 'secret'
+        try:
+            for headers, status in [({}, 404), ({'Authorization': 'Bearer wrong'}, 404),
+                                    ({'Authorization': 'Bearer secret'}, 200)]:
+                self.assertEqual(self.client.get('/metrics', headers=headers).status_code, status)
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+    def test_stats_dont_start_queues(self):
+        saved = ingest.write_behind_queue.replace(None)
+        try:
+            self.assertIn('app_ingest_queue_depth 0', self.client.get('/metrics').data.decode())
+            self.assertEqual(json.loads(self.client.get('/ingest_stats').data), {})
+            self.assertIsNone(ingest.write_behind_queue.current())
+        finally:
+            ingest.write_behind_queue.replace(saved)
+
+    def test_slow_requests_and_access(self):
+        app.config['METRICS_SLOW_REQUEST_MS'] = 0
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get('/open_activities')
+        self.assertIn('slow request: GET /open_activities? 200', logs.output[0])
+        self.assertRegex(logs.output[0], r'\d+ queries in \d+ ms, \d+ rows')
+        rv = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'})
+        self.assertEqual(rv.status_code, 404)
+
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    # just enough SMTP for smtplib; the server holds what was sent, and can
+    # answer the first DATA commands with a 451
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command == 'DATA':
+                self.reply('354 go ahead')
+                body = b''
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    body += line
+                with server.lock:
+                    fail = server.fail_data > 0
+                    server.fail_data -= fail
+                    if not fail:
+                        server.messages.append(body)
+                self.reply('451 try again later' if fail else '250 queued')
+            elif command.startswith('RCPT') and 'NOBODY@' in command:
+                self.reply('550 no such user')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class MailQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStandIn)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.fail_data = 0
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.state = app.extensions['mail']
+        self.saved = (self.state.server, self.state.port, self.state.suppress)
+        self.state.server, self.state.port = self.server.server_address
+        self.state.suppress = False
+
+    def tearDown(self):
+        self.state.server, self.state.port, self.state.suppress = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+
+    def message(self, n, to='student@example.com'):
+        return Message('Message {}'.format(n), sender='teacher@example.com', recipients=[to],
+                       body='number {}'.format(n))
+
+    def test_bulk_reuses_connections(self):
+        # a bulk sender that waits for room
+        q = MailQueue(workers=2, maxsize=10, batch_size=4, retry_delay=0.01, idle_timeout=5,
+                      put_timeout=5)
+        for n in range(30):
+            q.put(self.message(n))
+        q.join()
+        stats = q.stats()
+        q.close()
+        self.assertEqual(len(self.server.messages), 30)
+        self.assertEqual(sorted(int(m.split(b'number ')[1].split()[0]) for m in self.server.messages),
+                         list(range(30)))
+        self.assertEqual((stats['sent'], stats['failed'], stats['queue_depth']), (30, 0, 0))
+        # one connection per worker, not per message
+        self.assertLessEqual(self.server.connections, 2)
+        self.assertEqual(stats['connections'], self.server.connections)
+
+    def test_retries_transient_failures(self):
+        self.server.fail_data = 2
+        q = MailQueue(workers=1, batch_size=10, retries=2, retry_delay=0.01, idle_timeout=5)
+        for n in range(3):
+            q.put(self.message(n))
+        q.put(self.message(3, to='nobody@example.com'))
+        q.join()
+        stats = q.stats()
+        q.close()
+        self.assertEqual(len(self.server.messages), 3)
+        # the 451s are tried again on a new connection, the 550 isn't
+        self.assertEqual((stats['sent'], stats['failed'], stats['retried']), (3, 1, 2))
+        self.assertEqual(self.server.connections, 3)
+
+    def test_full_queue_doesnt_hold_up_requests(self):
+        from app import email
+        saved = email.mail_queue.replace(MailQueue(workers=0, maxsize=1))
+        try:
+            self.assertTrue(email.send_email('one', 'teacher@example.com', ['a@example.com'], 'x', 'x'))
+            with self.assertLogs(app.logger, 'ERROR'):
+                self.assertFalse(email.send_email('two', 'teacher@example.com', ['b@example.com'],
+                                                  'x', 'x'))
+            self.assertEqual(email.mail_queue().stats()['rejected'], 1)
+            # /metrics reports the queue without creating one
+            email.mail_queue.replace(None)
+            self.assertIn('app_mail_queue_depth 0', app.test_client().get('/metrics').data.decode())
+            self.assertIsNone(email.mail_queue.current())
+        finally:
+            email.mail_queue.replace(saved)
+
+    def test_gives_up_and_closes(self):
+        self.server.fail_data = 10
+        q = MailQueue(workers=1, retries=1, retry_delay=0.01, idle_timeout=0.05)
+        q.put(self.message(0))
+        q.put(self.message(1))
+        q.close()
+        self.assertEqual(q.stats()['failed'], 2)
+        self.assertEqual(self.server.messages, [])
+
+
+class LastSeenCase(unittest.TestCase):
+    # a file database, so the background writer sees the same tables
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + self.path
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        os.remove(self.path)
+
+    def test_throttled_background_update(self):
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime.utcnow() - timedelta(hours=1))
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(last_seen.mark_seen(u))
+        self.assertFalse(last_seen.mark_seen(u))
+        last_seen.last_seen_queue.replace(None).close()
+        self.assertNotIn(u.id, last_seen._queued)
+        db.session.expire_all()
+        self.assertLess(datetime.utcnow() - User.query.get(u.id).last_seen,
+                        timedelta(minutes=1))
+
+        fresh = User(username='susan', email='susan@example.com',
+                     last_seen=datetime.utcnow())
+        db.session.add(fresh)
+        db.session.commit()
+        self.assertFalse(last_seen.mark_seen(fresh))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)